@@ -1,16 +1,53 @@
+import time
+
+# 起動時間の内訳（importを含む）を計測するため、最初に開始時刻を記録
+STARTUP_STARTED_AT = time.perf_counter()
+
 from flask import Flask, request, jsonify, render_template, Response
 from flask_httpauth import HTTPBasicAuth
 from google import genai
 from google.genai import types
+from google.genai import errors as genai_errors
+import google.auth
 import json
 import os
 import re
 from datetime import datetime
 import hashlib
+import heapq
 import base64
 import gc
+import asyncio
+import contextvars
+import queue
+import random
+import sqlite3
+import ssl
+import struct
+import threading
+import unicodedata
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from itertools import islice
+from functools import lru_cache, wraps
+from types import MappingProxyType
+from contextlib import aclosing, asynccontextmanager, contextmanager
+import certifi
+import httpx
+import psutil
 from dotenv import load_dotenv
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # .envファイルを読み込み
 load_dotenv()
 
@@ -22,10 +59,183 @@ PROJECT_ID = os.environ.get('GOOGLE_CLOUD_PROJECT', 'dotd-development-division')
 RAG_CORPUS = os.environ.get('RAG_CORPUS', f'projects/{PROJECT_ID}/locations/us-central1/ragCorpora/5188146770730811392')
 GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-2.5-flash')
 
+# 深掘りモードの関連質問を同時に実行する最大数
+DEEP_MODE_MAX_PARALLEL = max(1, int(os.environ.get('DEEP_MODE_MAX_PARALLEL', '5')))
+
+# 深掘りモードの制限時間（秒、0で無制限。既定は無制限）と段階ごとの配分
+# 計画は全体のPLANNING_SHAREまで、関連質問は統合用にSYNTHESIS_SHAREを残した時点まで実行する
+DEEP_MODE_DEADLINE_SECONDS = max(0.0, float(os.environ.get('DEEP_MODE_DEADLINE_SECONDS', '0')))
+DEEP_MODE_MAX_DEADLINE_SECONDS = max(1.0, float(os.environ.get('DEEP_MODE_MAX_DEADLINE_SECONDS', '600')))
+DEEP_MODE_PLANNING_SHARE = float(os.environ.get('DEEP_MODE_PLANNING_SHARE', '0.2'))
+DEEP_MODE_SYNTHESIS_SHARE = float(os.environ.get('DEEP_MODE_SYNTHESIS_SHARE', '0.4'))
+# 関連質問の回答が届き始めない場合に同じ質問を重複実行するまでの秒数（0で無効）
+DEEP_MODE_HEDGE_DELAY_SECONDS = max(0.0, float(os.environ.get('DEEP_MODE_HEDGE_DELAY_SECONDS', '0')))
+# 関連質問の生成中にデフォルトの関連質問を先行実行するか（計画された質問と類似度が閾値以上なら再利用）
+DEEP_MODE_SPECULATIVE_PREFETCH = os.environ.get('DEEP_MODE_SPECULATIVE_PREFETCH', 'false').lower() in ('1', 'true', 'yes')
+DEEP_MODE_SPECULATION_MATCH_THRESHOLD = float(os.environ.get('DEEP_MODE_SPECULATION_MATCH_THRESHOLD', '0.7'))
+# 深掘りモードで各質問の検索を一度だけ行い、検索結果を生成呼び出しに埋め込むか
+# （有効にすると各回答は検索ツールを使わず埋め込んだ検索結果から生成する。
+#   保存済み回答の照合にも検索結果が必要なため、ストアのヒット時も検索APIを呼び出す）
+DEEP_MODE_SHARED_RETRIEVAL = os.environ.get('DEEP_MODE_SHARED_RETRIEVAL', 'false').lower() in ('1', 'true', 'yes')
+# 包括的な回答の入力（指示・計画・回答・検索結果）のトークン数の上限（0で無制限）と、重複とみなす類似度
+SYNTHESIS_INPUT_TOKEN_BUDGET = int(os.environ.get('SYNTHESIS_INPUT_TOKEN_BUDGET', '12000'))
+SYNTHESIS_DEDUP_THRESHOLD = float(os.environ.get('SYNTHESIS_DEDUP_THRESHOLD', '0.8'))
+# 1つの質問で取得する検索結果の件数
+RAG_RETRIEVAL_TOP_K = int(os.environ.get('RAG_RETRIEVAL_TOP_K', '10'))
+# 計画立案（調査計画と関連質問のJSON）の最大出力トークン数
+PLANNING_MAX_OUTPUT_TOKENS = int(os.environ.get('PLANNING_MAX_OUTPUT_TOKENS', '1024'))
+
+# genaiクライアントプール設定
+GENAI_CLIENT_POOL_SIZE = max(1, int(os.environ.get('GENAI_CLIENT_POOL_SIZE', '2')))
+GENAI_MAX_CONNECTIONS = int(os.environ.get('GENAI_MAX_CONNECTIONS', '40'))
+GENAI_KEEPALIVE_SECONDS = float(os.environ.get('GENAI_KEEPALIVE_SECONDS', '300'))
+GENAI_CLIENT_WARMUP = os.environ.get('GENAI_CLIENT_WARMUP', 'true').lower() in ('1', 'true', 'yes')
+# 起動時の準備でアクセストークンも取得し、最初のリクエストでのトークン取得を避ける
+STARTUP_FETCH_ACCESS_TOKEN = os.environ.get('STARTUP_FETCH_ACCESS_TOKEN', 'true').lower() in ('1', 'true', 'yes')
+
+# 上流（Gemini）呼び出しの流量制御設定（レート0で無制限。既定は無制限で、クォータに合わせて設定する）
+# 同時実行数の上限は、サーバーの同時接続数と深掘りモードの並列数を下回らないようにする
+UPSTREAM_MAX_CONCURRENCY = max(1, int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', '100')))
+UPSTREAM_RATE_PER_SECOND = float(os.environ.get('UPSTREAM_RATE_PER_SECOND', '0'))
+UPSTREAM_BURST = max(1, int(os.environ.get('UPSTREAM_BURST', '20')))
+UPSTREAM_MAX_RETRIES = max(0, int(os.environ.get('UPSTREAM_MAX_RETRIES', '4')))
+UPSTREAM_BACKOFF_BASE_SECONDS = float(os.environ.get('UPSTREAM_BACKOFF_BASE_SECONDS', '0.5'))
+UPSTREAM_BACKOFF_MAX_SECONDS = float(os.environ.get('UPSTREAM_BACKOFF_MAX_SECONDS', '8'))
+# RAG検索API（retrieveContexts）はGeminiとは別のクォータのため、別のトークンバケットで制御する
+RETRIEVAL_RATE_PER_SECOND = float(os.environ.get('RETRIEVAL_RATE_PER_SECOND', '0'))
+RETRIEVAL_BURST = max(1, int(os.environ.get('RETRIEVAL_BURST', '20')))
+
+# 通常モードの回答キャッシュ設定（最大件数0で無効）
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', '256'))
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get('ANSWER_CACHE_TTL_SECONDS', '3600'))
+
+# 深掘りモードのサブクエリ結果ストア設定（パスを空にすると無効）
+SUBQUERY_STORE_PATH = os.environ.get('SUBQUERY_STORE_PATH', '/tmp/cmp-chat-subqueries.sqlite3')
+SUBQUERY_STORE_MAX_BYTES = int(os.environ.get('SUBQUERY_STORE_MAX_BYTES', str(64 * 1024 * 1024)))
+SUBQUERY_STORE_WARM_ENTRIES = int(os.environ.get('SUBQUERY_STORE_WARM_ENTRIES', '500'))
+# コーパスを再インデックスしたら更新し、古い結果を参照しないようにする
+RAG_CORPUS_VERSION = os.environ.get('RAG_CORPUS_VERSION', '')
+
+# SSEストリームの再開設定
+STREAM_RESUME_WINDOW_SECONDS = float(os.environ.get('STREAM_RESUME_WINDOW_SECONDS', '300'))
+STREAM_BUFFER_MAX_EVENTS = int(os.environ.get('STREAM_BUFFER_MAX_EVENTS', '2000'))
+STREAM_HEARTBEAT_SECONDS = float(os.environ.get('STREAM_HEARTBEAT_SECONDS', '15'))
+STREAM_RETRY_MILLISECONDS = int(os.environ.get('STREAM_RETRY_MILLISECONDS', '3000'))
+# 受信者がいなくなってから生成を中止するまでの猶予（秒、0で即時中止）
+STREAM_DISCONNECT_GRACE_SECONDS = float(os.environ.get('STREAM_DISCONNECT_GRACE_SECONDS', '30'))
+# 同じ質問が生成中の場合、新たに生成せず既存のストリームを共有する
+COALESCE_INFLIGHT_REQUESTS = os.environ.get('COALESCE_INFLIGHT_REQUESTS', 'true').lower() in ('1', 'true', 'yes')
+
+# 短縮形式（compact / msgpack）のストリームで細かい断片をまとめる待ち時間の上限（ミリ秒、0で無効）
+STREAM_COALESCE_WINDOW_MS = float(os.environ.get('STREAM_COALESCE_WINDOW_MS', '30'))
+
+# /chatのストリーミング圧縮（Accept-Encodingでbr・gzipを受け付けるクライアントのみ）
+STREAM_COMPRESSION = os.environ.get('STREAM_COMPRESSION', 'false').lower() in ('1', 'true', 'yes')
+STREAM_GZIP_LEVEL = int(os.environ.get('STREAM_GZIP_LEVEL', '6'))
+STREAM_BROTLI_QUALITY = int(os.environ.get('STREAM_BROTLI_QUALITY', '5'))
+
+# メモリ管理（RSSがしきい値を超えた場合のみフルGCを実行）
+MEMORY_GC_RSS_THRESHOLD_MB = float(os.environ.get('MEMORY_GC_RSS_THRESHOLD_MB', '2048'))
+# 前回のフルGC後からRSSがこれ以上増えた場合もフルGCを実行（0で無効）
+MEMORY_GC_RSS_GROWTH_MB = float(os.environ.get('MEMORY_GC_RSS_GROWTH_MB', '256'))
+MEMORY_GC_MIN_INTERVAL_SECONDS = float(os.environ.get('MEMORY_GC_MIN_INTERVAL_SECONDS', '30'))
+# 起動処理の完了後に常駐オブジェクトをGCの対象から外す（gc.freeze）
+GC_FREEZE_AFTER_STARTUP = os.environ.get('GC_FREEZE_AFTER_STARTUP', 'true').lower() in ('1', 'true', 'yes')
+
+# リクエストトレース（フライトレコーダー）設定（保持件数を0にすると無効）
+TRACE_MAX_REQUESTS = int(os.environ.get('TRACE_MAX_REQUESTS', '200'))
+TRACE_MAX_SPANS = int(os.environ.get('TRACE_MAX_SPANS', '500'))
+# 最後のイベント（done: True）に処理時間の要約を付ける
+TRACE_TIMING_IN_DONE_EVENT = os.environ.get('TRACE_TIMING_IN_DONE_EVENT', 'false').lower() in ('1', 'true', 'yes')
+
 # 認証設定
 AUTH_USERNAME = os.environ.get('AUTH_USERNAME', 'u7F3kL9pQ2zX')
 AUTH_PASSWORD = os.environ.get('AUTH_PASSWORD', 's8Vn2BqT5wXc')
 
+class StartupProfile:
+    """起動処理の段階ごとの所要時間と準備状態を記録する
+    
+    import・認証・設定・クライアント作成などの段階を計測し、起動完了時に内訳をログに出力する。
+    いずれかの段階が失敗した場合は準備未完了とし、/ready は503を返す。
+    認証情報・クライアント・アクセストークンの失敗は一時的な場合があるため、/ready で再試行する。
+    gunicornの--preloadで起動した場合、記録はフォークしたワーカーに引き継がれる。
+    """
+    
+    def __init__(self, started_at):
+        self.started_at = started_at
+        self._lock = threading.Lock()
+        # プロセスの起動（インタープリターとgunicornの初期化）からimport開始までの時間
+        self._boot_seconds = max(0.0, time.time() - (time.perf_counter() - started_at) - psutil.Process().create_time())
+        self._phases = {'imports': {'seconds': time.perf_counter() - started_at, 'error': None}}
+        self._ready_at = None
+        self._pid = os.getpid()
+        self._preloaded = False
+        self._last_retry = 0.0
+    
+    @contextmanager
+    def phase(self, name):
+        """段階の所要時間を記録（失敗した場合は例外を記録して再送出）"""
+        started_at = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            with self._lock:
+                self._phases[name] = {'seconds': time.perf_counter() - started_at, 'error': error}
+    
+    def mark_ready(self):
+        """起動処理の完了を記録し、内訳をログに出力"""
+        with self._lock:
+            self._ready_at = time.perf_counter()
+            total = self._ready_at - self.started_at
+            failed = [name for name, phase in self._phases.items() if phase['error']]
+            breakdown = ', '.join(
+                f"{name} {phase['seconds'] * 1000:.0f}ms{' (failed)' if phase['error'] else ''}"
+                for name, phase in self._phases.items()
+            )
+        status = f"not ready ({', '.join(failed)} failed)" if failed else 'ready'
+        print(f"Startup: {status} in {total * 1000:.0f}ms (boot {self._boot_seconds * 1000:.0f}ms; {breakdown}) pid={self._pid}")
+    
+    def retry_failed(self, names, warm_up, min_interval_seconds):
+        """namesのいずれかの段階が失敗していればwarm_upを再実行（同時実行や短い間隔での再試行はしない）"""
+        with self._lock:
+            if not any(self._phases.get(name, {}).get('error') for name in names):
+                return False
+            if time.monotonic() - self._last_retry < min_interval_seconds:
+                return False
+            self._last_retry = time.monotonic()
+        warm_up()
+        with self._lock:
+            failed = [name for name in names if self._phases.get(name, {}).get('error')]
+        print(f"Startup: retried {', '.join(names)}: {'still failing (' + ', '.join(failed) + ')' if failed else 'ready'}")
+        return True
+    
+    def after_fork(self):
+        """--preloadで読み込み済みのアプリからフォークしたワーカーとして記録"""
+        self._pid = os.getpid()
+        self._preloaded = True
+        print(f"Startup: worker pid={self._pid} forked from preloaded app")
+    
+    def stats(self):
+        """準備状態と段階ごとの所要時間（秒）を取得"""
+        with self._lock:
+            phases = [{'name': name, **phase} for name, phase in self._phases.items()]
+            ready_at = self._ready_at
+        return {
+            'ready': ready_at is not None and not any(phase['error'] for phase in phases),
+            'pid': self._pid,
+            'preloaded': self._preloaded,
+            'boot_seconds': self._boot_seconds,
+            'startup_seconds': ready_at - self.started_at if ready_at is not None else None,
+            'phases': phases,
+        }
+
+startup_profile = StartupProfile(STARTUP_STARTED_AT)
+os.register_at_fork(after_in_child=startup_profile.after_fork)
+
 # RAGシステム共通設定
 RAG_SYSTEM_PROMPT = """あなたはRAG（Retrieval-Augmented Generation）システムです。以下のルールに厳密に従って回答してください：
 
@@ -38,6 +248,65 @@ RAG_SYSTEM_PROMPT = """あなたはRAG（Retrieval-Augmented Generation）シス
 
 これらのルールを絶対に守って、以下の質問に回答してください。"""
 
+# 通常モードの生成設定
+RESPONSE_CONFIG_PARAMS = {
+    'temperature': 1,
+    'top_p': 1,
+    'seed': 0,
+    'include_thinking': True,
+}
+
+# 深掘りモードのサブクエリ生成設定
+SUBQUERY_CONFIG_PARAMS = {
+    'temperature': 0.8,
+    'top_p': 0.9,
+}
+
+# 深掘りモードの計画立案の応答形式（調査計画と関連質問リストを1つのJSONで受け取る）
+PLAN_RESPONSE_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        'plan': types.Schema(type=types.Type.STRING),
+        'questions': types.Schema(
+            type=types.Type.ARRAY,
+            items=types.Schema(type=types.Type.STRING),
+            min_items=3,
+            max_items=5,
+        ),
+    },
+    required=['plan', 'questions'],
+    property_ordering=['plan', 'questions'],
+)
+
+# 深掘りモードの計画立案・統合回答の生成設定
+# 計画立案は出力が短いため、思考を無効にして出力トークン数を絞る
+PLANNING_CONFIG_PARAMS = {
+    'temperature': 0.7,
+    'max_tokens': PLANNING_MAX_OUTPUT_TOKENS,
+    'include_tools': False,
+    'include_thinking': True,
+    'thinking_budget': 0,
+    'response_schema': PLAN_RESPONSE_SCHEMA,
+}
+SYNTHESIS_CONFIG_PARAMS = {
+    'temperature': 0.7,
+    'include_tools': True,
+}
+
+# 共有検索ステージの結果をプロンプトに埋め込む場合（検索ツールを使わない）
+SUBQUERY_INLINE_CONFIG_PARAMS = dict(SUBQUERY_CONFIG_PARAMS, include_tools=False)
+SYNTHESIS_INLINE_CONFIG_PARAMS = dict(SYNTHESIS_CONFIG_PARAMS, include_tools=False)
+
+# 起動時に一度だけ作成する生成設定のプロファイル
+GENERATE_CONFIG_PROFILES = {
+    'response': RESPONSE_CONFIG_PARAMS,
+    'planning': PLANNING_CONFIG_PARAMS,
+    'subquery': SUBQUERY_CONFIG_PARAMS,
+    'synthesis': SYNTHESIS_CONFIG_PARAMS,
+    'subquery_inline': SUBQUERY_INLINE_CONFIG_PARAMS,
+    'synthesis_inline': SYNTHESIS_INLINE_CONFIG_PARAMS,
+}
+
 # デフォルト質問リスト生成
 def generate_default_questions(user_message):
     """デフォルトの関連質問リストを生成"""
@@ -49,6 +318,138 @@ def generate_default_questions(user_message):
         f"{user_message}に関連する技術や手法はありますか？"
     ]
 
+class RequestTrace:
+    """1回分の/chat生成の処理区間（スパン）を記録する
+    
+    スパンの開始位置はトレース開始からの経過時間で持つ。SSE変換のように件数の多い処理は
+    1件ずつではなく合計時間と回数だけを記録する。
+    """
+    
+    def __init__(self, trace_id, mode, message, max_spans):
+        self.id = trace_id
+        self.mode = mode
+        self.message = message[:100]
+        self.started_at = datetime.now()
+        self.spans = deque(maxlen=max_spans)
+        self.dropped_spans = 0
+        self.duration = None
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._totals = {}
+    
+    def add_span(self, name, started, duration, **attrs):
+        """区間を記録（startedはtime.monotonic()の値）"""
+        span = {
+            'name': name,
+            'start_ms': round((started - self._started) * 1000, 1),
+            'duration_ms': round(duration * 1000, 1),
+        }
+        span.update((key, value) for key, value in attrs.items() if value is not None)
+        with self._lock:
+            if len(self.spans) == self.spans.maxlen:
+                self.dropped_spans += 1
+            self.spans.append(span)
+    
+    def add_total(self, name, duration):
+        """件数の多い処理の所要時間を合算して記録"""
+        with self._lock:
+            count, total = self._totals.get(name, (0, 0.0))
+            self._totals[name] = (count + 1, total + duration)
+    
+    def finish(self):
+        self.duration = time.monotonic() - self._started
+    
+    def summary(self):
+        """区間名ごとの回数と最大・合計時間（ミリ秒）をまとめた要約"""
+        stages = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            entry = stages.setdefault(span['name'], {'count': 0, 'max_ms': 0.0, 'sum_ms': 0.0})
+            entry['count'] += 1
+            entry['max_ms'] = max(entry['max_ms'], span['duration_ms'])
+            entry['sum_ms'] = round(entry['sum_ms'] + span['duration_ms'], 1)
+        duration = self.duration if self.duration is not None else time.monotonic() - self._started
+        return {'trace_id': self.id, 'total_ms': round(duration * 1000, 1), 'stages': stages}
+    
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span['start_ms'])
+            totals = {
+                name: {'count': count, 'sum_ms': round(total * 1000, 1)}
+                for name, (count, total) in self._totals.items()
+            }
+        return {
+            'trace_id': self.id,
+            'mode': self.mode,
+            'message': self.message,
+            'started_at': self.started_at.isoformat(),
+            'duration_ms': round(self.duration * 1000, 1) if self.duration is not None else None,
+            'done': self.duration is not None,
+            'spans': spans,
+            'dropped_spans': self.dropped_spans,
+            'totals': totals,
+        }
+
+class RequestTraceRing:
+    """直近のトレースを上限件数まで保持するリングバッファ"""
+    
+    def __init__(self, max_requests, max_spans):
+        self.max_requests = max_requests
+        self.max_spans = max_spans
+        self._lock = threading.Lock()
+        self._traces = OrderedDict()
+    
+    def start(self, trace_id, mode, message):
+        """新しいトレースを開始（無効な場合はNone）"""
+        if self.max_requests <= 0:
+            return None
+        trace = RequestTrace(trace_id, mode, message, self.max_spans)
+        with self._lock:
+            self._traces[trace_id] = trace
+            while len(self._traces) > self.max_requests:
+                self._traces.popitem(last=False)
+        return trace
+    
+    def get(self, trace_id):
+        with self._lock:
+            return self._traces.get(trace_id)
+    
+    def recent(self, limit=50):
+        """新しい順にトレースの概要を取得"""
+        with self._lock:
+            traces = list(self._traces.values())[-limit:]
+        return [
+            {
+                'trace_id': trace.id,
+                'mode': trace.mode,
+                'message': trace.message,
+                'started_at': trace.started_at.isoformat(),
+                'duration_ms': round(trace.duration * 1000, 1) if trace.duration is not None else None,
+            }
+            for trace in reversed(traces)
+        ]
+
+request_traces = RequestTraceRing(TRACE_MAX_REQUESTS, TRACE_MAX_SPANS)
+# 実行中の生成タスクのトレース（asyncioのタスクやto_threadにも引き継がれる）
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+def traced(name):
+    """関数の実行時間を現在のトレースに区間として記録するデコレーター"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = current_trace.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            started = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace.add_span(name, started, time.monotonic() - started)
+        return wrapper
+    return decorator
+
 # 共通設定作成関数
 def create_rag_tools():
     """RAGツール設定を作成"""
@@ -75,7 +476,16 @@ def create_safety_settings():
         types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="OFF")
     ]
 
-def create_generate_config(temperature=0.8, top_p=0.9, max_tokens=65536, include_tools=True, include_thinking=False, seed=None):
+@lru_cache(maxsize=None)
+def is_thinking_config_available():
+    """ThinkingConfigが利用可能かを判定（結果はプロセス内でキャッシュ）"""
+    try:
+        types.GenerateContentConfig(thinking_config=types.ThinkingConfig(thinking_budget=-1))
+        return True
+    except (AttributeError, TypeError, ValueError, ImportError):
+        return False
+
+def create_generate_config(temperature=0.8, top_p=0.9, max_tokens=65536, include_tools=True, include_thinking=False, thinking_budget=-1, seed=None, response_schema=None):
     """GenerateContentConfigを作成"""
     config_params = {
         'temperature': temperature,
@@ -90,31 +500,34 @@ def create_generate_config(temperature=0.8, top_p=0.9, max_tokens=65536, include
     if include_tools:
         config_params['tools'] = create_rag_tools()
     
-    if include_thinking:
-        # ThinkingConfigが利用可能な場合のみ追加
-        try:
-            thinking_config_available = False
-            if hasattr(types, 'ThinkingConfig'):
-                test_config = types.ThinkingConfig(thinking_budget=-1)
-                thinking_config_available = True
-            else:
-                from google.genai.types import ThinkingConfig
-                test_config = ThinkingConfig(thinking_budget=-1)
-                thinking_config_available = True
-            
-            if thinking_config_available:
-                config_params['thinking_config'] = types.ThinkingConfig(thinking_budget=-1)
-        except (AttributeError, TypeError, ValueError, ImportError):
-            pass  # ThinkingConfigが利用できない場合は無視
+    if response_schema is not None:
+        config_params['response_mime_type'] = 'application/json'
+        config_params['response_schema'] = response_schema
     
-    # 安全にGenerateContentConfigを作成
-    try:
-        return types.GenerateContentConfig(**config_params)
-    except Exception:
-        # ThinkingConfigを除外して再試行
-        if 'thinking_config' in config_params:
-            del config_params['thinking_config']
-            return types.GenerateContentConfig(**config_params)
+    # ThinkingConfigが利用可能な場合のみ追加
+    if include_thinking and is_thinking_config_available():
+        config_params['thinking_config'] = types.ThinkingConfig(thinking_budget=thinking_budget)
+    
+    return types.GenerateContentConfig(**config_params)
+
+def build_generate_config_registry(profiles):
+    """プロファイルごとの生成設定を一度だけ作成し、読み取り専用の辞書として返す"""
+    return MappingProxyType({
+        name: create_generate_config(**params)
+        for name, params in profiles.items()
+    })
+
+with startup_profile.phase('configs'):
+    generate_config_registry = build_generate_config_registry(GENERATE_CONFIG_PROFILES)
+
+@traced('config')
+def get_generate_config(profile):
+    """登録済みの生成設定を取得
+    
+    返される設定は全リクエストで共有されるため変更しないこと。
+    設定を変えたい場合は`model_copy(update=...)`で複製する。
+    """
+    return generate_config_registry[profile]
 
 def extract_grounding_metadata(response_or_chunk):
     """レスポンスまたはチャンクからグラウンディングメタデータを抽出"""
@@ -218,77 +631,966 @@ def validate_and_fix_private_key(private_key):
         print(f"Warning: Could not fix private key Base64 padding: {e}")
         return private_key
 
+@lru_cache(maxsize=4)
+def parse_service_account_info(credentials_json):
+    """サービスアカウントキーのJSONを検証し、プライベートキーを修正して返す
+    
+    同じ文字列の解析とキーの再エンコードは一度だけ行う。必須項目が欠けている場合はNone。
+    """
+    parsed_json = json.loads(credentials_json)
+    
+    # 必要なフィールドが含まれているかチェック
+    required_fields = ['type', 'project_id', 'private_key_id', 'private_key', 'client_email']
+    missing_fields = [field for field in required_fields if field not in parsed_json]
+    
+    if missing_fields:
+        print(f"Warning: Missing required fields in Google Cloud credentials: {missing_fields}")
+        return None
+    
+    # プライベートキーのBase64パディングを修正
+    original_key = parsed_json['private_key']
+    fixed_key = validate_and_fix_private_key(original_key)
+    if fixed_key != original_key:
+        print("INFO: Fixed private key Base64 padding")
+        parsed_json['private_key'] = fixed_key
+    
+    return MappingProxyType(parsed_json)
+
 def setup_google_auth():
-    """Google Cloud認証を設定"""
+    """Google Cloud認証を設定（サービスアカウントキーのJSONがあれば解析済みの内容を返す）"""
     # 環境変数からサービスアカウントキーのJSONを読み込む
     credentials_json = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS_JSON')
     
     if credentials_json:
         try:
-            # JSONの妥当性をチェック
-            parsed_json = json.loads(credentials_json)
-            
-            # 必要なフィールドが含まれているかチェック
-            required_fields = ['type', 'project_id', 'private_key_id', 'private_key', 'client_email']
-            missing_fields = [field for field in required_fields if field not in parsed_json]
-            
-            if missing_fields:
-                print(f"Warning: Missing required fields in Google Cloud credentials: {missing_fields}")
-                return
-            
-            # プライベートキーのBase64パディングを修正
-            if 'private_key' in parsed_json:
-                original_key = parsed_json['private_key']
-                fixed_key = validate_and_fix_private_key(original_key)
-                if fixed_key != original_key:
-                    print("INFO: Fixed private key Base64 padding")
-                    parsed_json['private_key'] = fixed_key
-            
-            # 環境変数として直接設定（ファイル作成不要）
-            os.environ['GOOGLE_APPLICATION_CREDENTIALS_JSON'] = json.dumps(parsed_json)
-                
+            return parse_service_account_info(credentials_json)
         except json.JSONDecodeError as e:
             print(f"Error: Invalid JSON in GOOGLE_APPLICATION_CREDENTIALS_JSON: {e}")
             print("Please check the format of your Google Cloud credentials JSON.")
-            return
+            return None
         except Exception as e:
             print(f"Error setting up Google Cloud authentication: {e}")
-            return
+            return None
     
     # 既存のGOOGLE_APPLICATION_CREDENTIALSがある場合はそのまま使用
-    if not os.environ.get('GOOGLE_APPLICATION_CREDENTIALS') and not credentials_json:
+    if not os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'):
         print("Warning: Google Cloud認証情報が設定されていません")
         print("以下の環境変数のいずれかを設定してください:")
         print("- GOOGLE_APPLICATION_CREDENTIALS: サービスアカウントキーファイルのパス")
         print("- GOOGLE_APPLICATION_CREDENTIALS_JSON: サービスアカウントキーのJSON文字列")
+    return None
 
 # 認証設定を初期化
-setup_google_auth()
+with startup_profile.phase('auth'):
+    service_account_info = setup_google_auth()
+
+def refresh_google_credentials(credentials):
+    """アクセストークンを更新（requestsの読み込みは最初の更新まで遅らせる）"""
+    from google.auth.transport.requests import Request as GoogleAuthRequest
+    credentials.refresh(GoogleAuthRequest())
+
+class GoogleCredentials:
+    """genaiクライアントとRAG検索APIで共有する認証情報
+    
+    サービスアカウントキーのJSONが設定されていればその内容から、なければアプリケーションの
+    デフォルト認証情報から一度だけ作成する。クライアントごとの読み込みを避けるため、
+    作成した認証情報（取得済みのアクセストークンを含む）をすべてのクライアントに渡す。
+    """
+    
+    SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+    
+    def __init__(self, service_account_info=None):
+        self.service_account_info = service_account_info
+        # 読み込みとトークンの更新（ネットワーク呼び出し）は統計用のロックとは別のロックで直列化する
+        self._refresh_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._source = None
+        self._refreshes = 0
+    
+    def get(self):
+        """認証情報を取得（初回のみ読み込み）"""
+        credentials = self._credentials
+        if credentials is not None:
+            return credentials
+        with self._refresh_lock:
+            if self._credentials is None:
+                if self.service_account_info:
+                    from google.oauth2 import service_account
+                    credentials = service_account.Credentials.from_service_account_info(
+                        dict(self.service_account_info), scopes=self.SCOPES
+                    )
+                    source = 'service_account_json'
+                else:
+                    credentials, _ = google.auth.default(scopes=self.SCOPES)
+                    source = 'default'
+                with self._lock:
+                    self._credentials = credentials
+                    self._source = source
+            return self._credentials
+    
+    def token(self):
+        """アクセストークンを取得（期限切れの場合は更新）"""
+        credentials = self.get()
+        if credentials.valid:
+            return credentials.token
+        with self._refresh_lock:
+            if not credentials.valid:
+                refresh_google_credentials(credentials)
+                with self._lock:
+                    self._refreshes += 1
+            return credentials.token
+    
+    def stats(self):
+        """認証情報の読み込み状況を取得"""
+        with self._lock:
+            credentials = self._credentials
+            source = self._source
+            refreshes = self._refreshes
+        return {
+            'loaded': credentials is not None,
+            'source': source,
+            'valid': credentials.valid if credentials is not None else False,
+            'refreshes': refreshes,
+        }
+
+google_credentials = GoogleCredentials(service_account_info)
+
+@lru_cache(maxsize=None)
+def get_shared_ssl_context():
+    """上流への接続で共有するSSLコンテキスト（CA証明書の読み込みはプロセス内で一度だけ）"""
+    return ssl.create_default_context(
+        cafile=os.environ.get('SSL_CERT_FILE', certifi.where()),
+        capath=os.environ.get('SSL_CERT_DIR'),
+    )
 
 def create_rag_client():
     """RAGクライアントを作成"""
+    # 接続をプール内で使い回すため、HTTPコネクションのキープアライブを設定
+    limits = httpx.Limits(
+        max_connections=GENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=GENAI_MAX_CONNECTIONS,
+        keepalive_expiry=GENAI_KEEPALIVE_SECONDS,
+    )
+    # 認証情報とSSLコンテキストは共有し、クライアントごとの読み込みを避ける
+    ssl_context = get_shared_ssl_context()
     client = genai.Client(
         vertexai=True,
         project=PROJECT_ID,
         location="global",
+        credentials=google_credentials.get(),
+        http_options=types.HttpOptions(
+            client_args={'limits': limits, 'verify': ssl_context},
+            async_client_args={'limits': limits, 'verify': ssl_context, 'ssl': ssl_context},
+        ),
     )
     return client
 
+class RagClientPool:
+    """プロセス内で共有するgenaiクライアントのプール
+    
+    genai.Clientはスレッドセーフなため、貸し出し中のクライアントも他のスレッドと共有する。
+    貸し出し時は利用中の数が最も少ないクライアントを選ぶ。
+    """
+    
+    def __init__(self, size, factory):
+        self.size = size
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._clients = []
+        self._in_use = []
+        self._acquisitions = 0
+        self._reused = 0
+        self._created = 0
+        self._peak_in_use = 0
+    
+    def _create_locked(self):
+        client = self._factory()
+        self._clients.append(client)
+        self._in_use.append(0)
+        self._created += 1
+        return len(self._clients) - 1
+    
+    def warm_up(self):
+        """プールを上限まで事前に作成"""
+        with self._lock:
+            while len(self._clients) < self.size:
+                self._create_locked()
+    
+    @contextmanager
+    def client(self):
+        """クライアントを貸し出す（ロック待ちと作成を含む所要時間を現在のトレースに記録）"""
+        started = time.monotonic()
+        created = False
+        with self._lock:
+            if len(self._clients) < self.size and (not self._in_use or min(self._in_use) > 0):
+                index = self._create_locked()
+                created = True
+            else:
+                index = min(range(len(self._clients)), key=self._in_use.__getitem__)
+                self._reused += 1
+            self._in_use[index] += 1
+            self._acquisitions += 1
+            self._peak_in_use = max(self._peak_in_use, sum(self._in_use))
+            client = self._clients[index]
+            leases = self._in_use[index]
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add_span('client_pool.acquire', started, time.monotonic() - started,
+                           client=index, leases=leases, created=created or None)
+        try:
+            yield client
+        finally:
+            with self._lock:
+                self._in_use[index] -= 1
+    
+    def stats(self):
+        """プールの利用状況を取得"""
+        with self._lock:
+            acquisitions = self._acquisitions
+            return {
+                'size': self.size,
+                'clients': len(self._clients),
+                'idle_clients': self._in_use.count(0),
+                'in_use': sum(self._in_use),
+                'peak_in_use': self._peak_in_use,
+                'acquisitions': acquisitions,
+                'reused': self._reused,
+                'created': self._created,
+                'reuse_rate': self._reused / acquisitions if acquisitions else 0.0,
+            }
+
+rag_client_pool = RagClientPool(GENAI_CLIENT_POOL_SIZE, create_rag_client)
+
+def rag_client():
+    """共有プールからRAGクライアントを借りる"""
+    return rag_client_pool.client()
+
+def warm_up_rag_client_pool():
+    """起動時に認証情報の読み込み・アクセストークンの取得・クライアントの作成を済ませる"""
+    try:
+        with startup_profile.phase('credentials'):
+            google_credentials.get()
+        with startup_profile.phase('clients'):
+            rag_client_pool.warm_up()
+        if STARTUP_FETCH_ACCESS_TOKEN:
+            with startup_profile.phase('access_token'):
+                google_credentials.token()
+    except Exception as e:
+        print(f"Warning: Could not warm up genai client pool: {e}")
+
+if GENAI_CLIENT_WARMUP:
+    warm_up_rag_client_pool()
+
+# 起動時に失敗した場合に/readyで再試行する段階と、再試行の最短間隔（秒）
+WARM_UP_PHASES = ('credentials', 'clients', 'access_token')
+WARM_UP_RETRY_INTERVAL_SECONDS = 5.0
+
+class UpstreamOverloadedError(Exception):
+    """リトライしても上流のクォータ超過・過負荷が解消しなかった"""
+    
+    def __init__(self, operation, error):
+        code, status = get_upstream_error_code(error)
+        super().__init__(f"上流サービスが混雑しています（{operation}: {status or code}）。しばらくしてから再度お試しください。")
+        self.operation = operation
+        self.error = error
+
+# 上流の呼び出しで再試行の対象とする例外
+UPSTREAM_ERRORS = (genai_errors.APIError, httpx.HTTPStatusError)
+
+def get_upstream_error_code(error):
+    """上流エラーの (HTTPステータスコード, ステータス名) を取得"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code, None
+    return error.code, error.status
+
+def is_retryable_upstream_error(error):
+    """クォータ超過（429/RESOURCE_EXHAUSTED）または一時的な過負荷（503/UNAVAILABLE）かどうかを判定"""
+    if not isinstance(error, UPSTREAM_ERRORS):
+        return False
+    code, status = get_upstream_error_code(error)
+    return code in (429, 503) or status in ('RESOURCE_EXHAUSTED', 'UNAVAILABLE')
+
+class TokenBucket:
+    """呼び出し回数を平均rate回/秒、最大burst回までの連続に抑えるトークンバケット"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+    
+    async def acquire(self):
+        """トークンを1つ取得し、待機した秒数を返す（待機者は到着順に処理）"""
+        if self.rate <= 0:
+            return 0.0
+        async with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            wait = (1 - self._tokens) / self.rate
+            await asyncio.sleep(wait)
+            self._refill()
+            self._tokens -= 1
+            return wait
+
+class UpstreamGateway:
+    """Geminiへの呼び出しを集約し、同時実行数・レート・リトライを制御する
+    
+    同時実行数の上限とトークンバケットで送信を平準化し、クォータ超過や過負荷の応答には
+    ジッター付き指数バックオフで再試行する。ストリーミングは最初のチャンクを受信する前の
+    失敗のみ再試行する（送信済みの断片を重複させないため）。
+    """
+    
+    def __init__(self, max_concurrency, rate, burst, max_retries, backoff_base, backoff_max):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._bucket = TokenBucket(rate, burst)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._in_flight = 0
+        self._peak_waiting = 0
+        self._calls = 0
+        self._throttled = 0
+        self._retries = 0
+        self._exhausted = 0
+        self._wait_sum = 0.0
+        self._wait_max = 0.0
+    
+    def _backoff(self, attempt):
+        """再試行までの待機秒数（フルジッター）"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+    
+    @asynccontextmanager
+    async def _slot(self, operation):
+        """レートと同時実行数の枠を確保（枠内で発生したエラーは種類ごとに数える）"""
+        started_at = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+            self._peak_waiting = max(self._peak_waiting, self._waiting)
+        try:
+            throttled = await self._bucket.acquire() > 0
+            await self._semaphore.acquire()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        wait = time.monotonic() - started_at
+        with self._lock:
+            self._in_flight += 1
+            self._calls += 1
+            self._throttled += throttled
+            self._wait_sum += wait
+            self._wait_max = max(self._wait_max, wait)
+        acquired_at = time.monotonic()
+        error_type = None
+        try:
+            yield
+        except Exception as e:
+            error_type = get_upstream_error_type(e)
+            upstream_errors_counter.inc(operation=operation, type=error_type)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._semaphore.release()
+            trace = current_trace.get()
+            if trace is not None:
+                trace.add_span(
+                    f'upstream.{operation}', acquired_at, time.monotonic() - acquired_at,
+                    wait_ms=round(wait * 1000, 1), error=error_type
+                )
+    
+    async def _retry_or_raise(self, operation, error, attempt):
+        """再試行できる失敗ならバックオフ後に戻り、できなければ例外を送出"""
+        if not is_retryable_upstream_error(error):
+            raise error
+        if attempt >= self.max_retries:
+            with self._lock:
+                self._exhausted += 1
+            raise UpstreamOverloadedError(operation, error) from error
+        delay = self._backoff(attempt)
+        with self._lock:
+            self._retries += 1
+        print(f"Upstream {operation} failed ({error}), retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+    
+    async def call(self, operation, func):
+        """func（引数なしでコルーチンを返す関数）を流量制御・再試行付きで呼び出す"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._slot(operation):
+                    return await func()
+            except UPSTREAM_ERRORS as e:
+                await self._retry_or_raise(operation, e, attempt)
+    
+    async def generate_content(self, operation, **kwargs):
+        """generate_contentを流量制御・再試行付きで呼び出す"""
+        async def generate():
+            with rag_client() as client:
+                response = await client.aio.models.generate_content(**kwargs)
+            record_usage_metadata(operation, response.usage_metadata)
+            return response
+        return await self.call(operation, generate)
+    
+    async def generate_content_stream(self, operation, **kwargs):
+        """generate_content_streamを流量制御・再試行付きで呼び出し、チャンクを順次yield"""
+        for attempt in range(self.max_retries + 1):
+            received = False
+            usage_metadata = None
+            try:
+                async with self._slot(operation):
+                    with rag_client() as client:
+                        async for chunk in await client.aio.models.generate_content_stream(**kwargs):
+                            received = True
+                            # トークン数は最後のチャンクに累計で入る
+                            usage_metadata = getattr(chunk, 'usage_metadata', None) or usage_metadata
+                            yield chunk
+                return
+            except genai_errors.APIError as e:
+                if received:
+                    raise
+                await self._retry_or_raise(operation, e, attempt)
+            finally:
+                record_usage_metadata(operation, usage_metadata)
+    
+    def stats(self):
+        """待ち行列と再試行の状況を取得（待機時間は秒）"""
+        with self._lock:
+            return {
+                'max_concurrency': self.max_concurrency,
+                'rate_per_second': self._bucket.rate,
+                'burst': self._bucket.burst,
+                'in_flight': self._in_flight,
+                'waiting': self._waiting,
+                'peak_waiting': self._peak_waiting,
+                'calls': self._calls,
+                'throttled': self._throttled,
+                'retries': self._retries,
+                'exhausted': self._exhausted,
+                'wait_avg': self._wait_sum / self._calls if self._calls else 0.0,
+                'wait_max': self._wait_max,
+            }
+
+upstream_gateway = UpstreamGateway(
+    UPSTREAM_MAX_CONCURRENCY,
+    UPSTREAM_RATE_PER_SECOND,
+    UPSTREAM_BURST,
+    UPSTREAM_MAX_RETRIES,
+    UPSTREAM_BACKOFF_BASE_SECONDS,
+    UPSTREAM_BACKOFF_MAX_SECONDS,
+)
+
+# 検索呼び出しが生成呼び出しのレートと同時実行数の枠を消費しないよう、別のゲートウェイを使う
+retrieval_gateway = UpstreamGateway(
+    UPSTREAM_MAX_CONCURRENCY,
+    RETRIEVAL_RATE_PER_SECOND,
+    RETRIEVAL_BURST,
+    UPSTREAM_MAX_RETRIES,
+    UPSTREAM_BACKOFF_BASE_SECONDS,
+    UPSTREAM_BACKOFF_MAX_SECONDS,
+)
+
+class RagRetriever:
+    """RAGコーパスの検索API（retrieveContexts）を直接呼び出す
+    
+    深掘りモードで各質問の検索を一度だけ行い、生成呼び出しには検索結果を埋め込んで渡すために使う。
+    認証情報はgenaiクライアントと共有する。
+    """
+    
+    def __init__(self, rag_corpus, top_k):
+        self.rag_corpus = rag_corpus
+        self.top_k = top_k
+        parent = rag_corpus.split('/ragCorpora/')[0]
+        location = parent.rsplit('/', 1)[-1]
+        self.url = f"https://{location}-aiplatform.googleapis.com/v1/{parent}:retrieveContexts"
+        self._client = None
+    
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(30.0, connect=10.0), verify=get_shared_ssl_context()
+            )
+        return self._client
+    
+    async def retrieve(self, query):
+        """1つの質問で検索し、検索結果（title, uri, text, score）のリストを返す"""
+        body = {
+            'vertex_rag_store': {'rag_resources': [{'rag_corpus': self.rag_corpus}]},
+            'query': {'text': query, 'rag_retrieval_config': {'top_k': self.top_k}},
+        }
+        
+        async def post():
+            token = await asyncio.to_thread(google_credentials.token)
+            response = await self._get_client().post(
+                self.url, json=body, headers={'Authorization': f'Bearer {token}'}
+            )
+            response.raise_for_status()
+            return response.json()
+        
+        data = await retrieval_gateway.call('retrieval', post)
+        contexts = []
+        for context in (data.get('contexts') or {}).get('contexts') or []:
+            uri = context.get('sourceUri', '')
+            contexts.append({
+                'title': context.get('sourceDisplayName') or uri.rsplit('/', 1)[-1] or 'タイトルなし',
+                'uri': uri,
+                'text': context.get('text', ''),
+                'score': context.get('score'),
+            })
+        return contexts
+    
+    async def retrieve_many(self, shared_query, questions):
+        """元の質問と関連質問の検索を重複を除いて並行実行し、SharedRetrievalを返す"""
+        queries = [shared_query, *questions]
+        unique_queries = {}
+        for query in queries:
+            unique_queries.setdefault(normalize_question(query), query)
+        started_at = time.monotonic()
+        results = await asyncio.gather(*(self.retrieve(query) for query in unique_queries.values()))
+        stage_latency.record('retrieval', None, time.monotonic() - started_at)
+        retrieval = SharedRetrieval(dict(zip(unique_queries, results)), shared_query)
+        retrieval_stats.inc('requests')
+        retrieval_stats.inc('queries', len(unique_queries))
+        retrieval_stats.inc('duplicate_queries', len(queries) - len(unique_queries))
+        retrieval_stats.inc('contexts', sum(len(result) for result in results))
+        retrieval_stats.inc('unique_contexts', len(retrieval.pooled()))
+        return retrieval
+
+class SharedRetrieval:
+    """1リクエスト分の検索結果（正規化した質問 -> 検索結果のリスト）
+    
+    各関連質問には、その質問と元の質問（shared_query）の検索結果を合わせて渡す。
+    """
+    
+    def __init__(self, results, shared_query):
+        self._results = results
+        self.shared_query = shared_query
+    
+    def contexts_for(self, *queries):
+        """指定した質問の検索結果を重複を除いて結合"""
+        contexts = []
+        seen = set()
+        for query in queries:
+            for context in self._results.get(normalize_question(query), []):
+                key = (context['uri'], context['text'])
+                if key not in seen:
+                    seen.add(key)
+                    contexts.append(context)
+        return contexts
+    
+    def contexts_for_question(self, question):
+        """関連質問の回答に使う検索結果"""
+        return self.contexts_for(question, self.shared_query)
+    
+    def pooled(self):
+        """全ての質問の検索結果を重複を除いて結合"""
+        return self.contexts_for(*self._results)
+
+def format_contexts(contexts):
+    """検索結果をプロンプトに埋め込む形式に整形"""
+    if not contexts:
+        return "（該当する検索結果はありません）"
+    return "\n\n".join(
+        f"[{i}] {context['title']}\n{context['text']}"
+        for i, context in enumerate(contexts, 1)
+    )
+
+def build_grounding_metadata(contexts):
+    """検索結果から、検索ツール使用時と同じ形式のグラウンディングメタデータを作成"""
+    return types.GroundingMetadata(grounding_chunks=[
+        types.GroundingChunk(retrieved_context=types.GroundingChunkRetrievedContext(
+            title=context['title'],
+            uri=context['uri'],
+            text=context['text'],
+        ))
+        for context in contexts
+    ])
+
+rag_retriever = RagRetriever(RAG_CORPUS, RAG_RETRIEVAL_TOP_K)
+
+def normalize_question(question):
+    """キャッシュキー用に質問文を正規化（全角/半角・空白・大文字小文字の揺れを吸収）"""
+    normalized = unicodedata.normalize('NFKC', question or '')
+    normalized = re.sub(r'\s+', ' ', normalized).strip().lower()
+    return normalized.rstrip('?？。.!！ ')
+
+class AnswerCache:
+    """LRU方式・有効期限付きの回答キャッシュ（スレッドセーフ）"""
+    
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # キー -> (有効期限, イベントのリスト)
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+    
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+    
+    def make_key(self, question, config_params):
+        """質問・モデル・コーパス・生成設定からキーを作成"""
+        key_source = json.dumps(
+            [normalize_question(question), GEMINI_MODEL, RAG_CORPUS, config_params],
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """キャッシュ済みのイベント列を取得（なければNone）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            expires_at, events = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return events
+    
+    def put(self, key, events):
+        """イベント列を保存し、上限を超えた古いエントリを削除"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, tuple(events))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+    
+    def invalidate(self, key=None):
+        """指定キー、または全エントリを削除して削除件数を返す"""
+        with self._lock:
+            if key is None:
+                removed = len(self._entries)
+                self._entries.clear()
+            else:
+                removed = 1 if self._entries.pop(key, None) is not None else 0
+            self._invalidations += removed
+            return removed
+    
+    def stats(self):
+        """キャッシュの利用状況を取得"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'invalidations': self._invalidations,
+            }
+
+answer_cache = AnswerCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS)
+
+class SubqueryStore:
+    """サブクエリ結果（回答テキストと変換済み出典情報）のSQLiteストア
+    
+    同一ノード上のワーカープロセス間でファイルを共有する。WALモードで複数プロセスからの
+    同時読み書きに対応し、合計サイズが上限を超えたら最終参照が古い順に削除する。
+    キーにはコーパス名とRAG_CORPUS_VERSIONを含めるため、再インデックス時は
+    バージョンを更新すれば古い結果は参照されない。
+    メモリ上の頻出エントリへのヒットも、一定間隔でまとめて最終参照日時とヒット数に反映する。
+    """
+    
+    WARM_HIT_FLUSH_SECONDS = 10.0
+    
+    def __init__(self, path, max_bytes, warm_entries):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.warm_entries = warm_entries
+        self.corpus_key = f"{RAG_CORPUS}@{RAG_CORPUS_VERSION}"
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._warm = {}  # 起動時に読み込んだ頻出エントリ
+        self._pending_warm_hits = {}  # キー -> (ヒット数, 最終参照日時)（SQLiteへの反映待ち）
+        self._last_warm_flush = time.monotonic()
+        self._hits = 0
+        self._warm_hits = 0
+        self._misses = 0
+        self._writes = 0
+        self._evictions = 0
+        self._errors = 0
+    
+    @property
+    def enabled(self):
+        return bool(self.path)
+    
+    def _connection(self):
+        """スレッドごとのSQLite接続を取得"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS subquery_results (
+                    key TEXT PRIMARY KEY,
+                    corpus_key TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    sources TEXT,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_subquery_last_access ON subquery_results (last_access)')
+            conn.commit()
+            self._local.conn = conn
+        return conn
+    
+    def _count(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+    
+    def make_key(self, question, contexts=None):
+        """質問・モデル・コーパスのバージョン・生成設定・検索方式からキーを作成
+        
+        検索結果を埋め込んで回答した場合（contextsあり）は、埋め込んだ検索結果の内容もキーに含め、
+        他の元の質問から得た検索結果に基づく回答を使い回さない。
+        """
+        if contexts is None:
+            retrieval = ['tool', SUBQUERY_CONFIG_PARAMS]
+        else:
+            contexts_source = json.dumps(
+                sorted((context.get('uri', ''), context.get('text', '')) for context in contexts),
+                ensure_ascii=False,
+            )
+            retrieval = ['inline', SUBQUERY_INLINE_CONFIG_PARAMS, hashlib.sha256(contexts_source.encode('utf-8')).hexdigest()]
+        key_source = json.dumps(
+            [normalize_question(question), GEMINI_MODEL, self.corpus_key, retrieval],
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+    
+    def get(self, question, contexts=None):
+        """保存済みの (回答, 変換済みメタデータ) を取得（なければNone）"""
+        if not self.enabled:
+            return None
+        
+        key = self.make_key(question, contexts)
+        warm = self._warm.get(key)
+        if warm is not None:
+            self._count('_warm_hits')
+            self._count('_hits')
+            self._record_warm_hit(key)
+            return warm
+        
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                'SELECT answer, sources FROM subquery_results WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                self._count('_misses')
+                return None
+            conn.execute(
+                'UPDATE subquery_results SET last_access = ?, hits = hits + 1 WHERE key = ?',
+                (time.time(), key),
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Warning: subquery store read failed: {e}")
+            self._count('_errors')
+            return None
+        
+        self._count('_hits')
+        answer, sources = row
+        return answer, json.loads(sources) if sources else None
+    
+    def _record_warm_hit(self, key):
+        """メモリ上のヒットを記録し、前回の反映から一定時間経っていればSQLiteに反映"""
+        with self._lock:
+            hits, _ = self._pending_warm_hits.get(key, (0, 0.0))
+            self._pending_warm_hits[key] = (hits + 1, time.time())
+            if time.monotonic() - self._last_warm_flush < self.WARM_HIT_FLUSH_SECONDS:
+                return
+        try:
+            self._flush_warm_hits(self._connection())
+        except sqlite3.Error as e:
+            print(f"Warning: subquery store warm hit update failed: {e}")
+            self._count('_errors')
+    
+    def _flush_warm_hits(self, conn):
+        """反映待ちのヒットの最終参照日時とヒット数を更新（削除や次回起動時の順位付けに使われるため）"""
+        with self._lock:
+            pending, self._pending_warm_hits = self._pending_warm_hits, {}
+            self._last_warm_flush = time.monotonic()
+        if not pending:
+            return
+        conn.executemany(
+            'UPDATE subquery_results SET last_access = MAX(last_access, ?), hits = hits + ? WHERE key = ?',
+            [(last_access, hits, key) for key, (hits, last_access) in pending.items()],
+        )
+        conn.commit()
+    
+    def put(self, question, answer, converted_metadata, contexts=None):
+        """結果を保存し、サイズ上限を超えた分を削除"""
+        if not self.enabled:
+            return
+        
+        sources = json.dumps(converted_metadata, ensure_ascii=False) if converted_metadata else None
+        size = len(answer.encode('utf-8')) + len(sources.encode('utf-8') if sources else b'') + len(question.encode('utf-8'))
+        now = time.time()
+        
+        try:
+            conn = self._connection()
+            conn.execute(
+                'INSERT OR REPLACE INTO subquery_results '
+                '(key, corpus_key, question, answer, sources, size, created_at, last_access, hits) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)',
+                (self.make_key(question, contexts), self.corpus_key, question, answer, sources, size, now, now),
+            )
+            conn.commit()
+            self._count('_writes')
+            self._evict(conn)
+        except sqlite3.Error as e:
+            print(f"Warning: subquery store write failed: {e}")
+            self._count('_errors')
+    
+    def _evict(self, conn):
+        """合計サイズが上限を超えたら最終参照が古い順に削除（上限の90%まで）"""
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM subquery_results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        # メモリ上でヒットしたエントリが古いものとして削除されないよう、先に最終参照日時を反映
+        self._flush_warm_hits(conn)
+        target = int(self.max_bytes * 0.9)
+        removed = 0
+        rows = conn.execute('SELECT key, size FROM subquery_results ORDER BY last_access ASC').fetchall()
+        for key, size in rows:
+            if total <= target:
+                break
+            conn.execute('DELETE FROM subquery_results WHERE key = ?', (key,))
+            self._warm.pop(key, None)
+            total -= size
+            removed += 1
+        conn.commit()
+        self._count('_evictions', removed)
+    
+    def warm_start(self):
+        """起動時に他バージョンの結果を削除し、頻出エントリをメモリに読み込む"""
+        if not self.enabled:
+            return
+        
+        try:
+            conn = self._connection()
+            conn.execute('DELETE FROM subquery_results WHERE corpus_key != ?', (self.corpus_key,))
+            conn.commit()
+            rows = conn.execute(
+                'SELECT key, answer, sources FROM subquery_results '
+                'ORDER BY hits DESC, last_access DESC LIMIT ?',
+                (self.warm_entries,),
+            ).fetchall()
+        except sqlite3.Error as e:
+            print(f"Warning: subquery store warm start failed: {e}")
+            self._count('_errors')
+            return
+        
+        self._warm = {
+            key: (answer, json.loads(sources) if sources else None)
+            for key, answer, sources in rows
+        }
+    
+    def after_fork(self):
+        """フォークした子プロセスでは親のSQLite接続を使わず、新たに接続する"""
+        self._local = threading.local()
+    
+    def invalidate(self):
+        """全エントリを削除して削除件数を返す"""
+        self._warm = {}
+        with self._lock:
+            self._pending_warm_hits = {}
+        if not self.enabled:
+            return 0
+        try:
+            conn = self._connection()
+            removed = conn.execute('DELETE FROM subquery_results').rowcount
+            conn.commit()
+            return removed
+        except sqlite3.Error as e:
+            print(f"Warning: subquery store invalidation failed: {e}")
+            self._count('_errors')
+            return 0
+    
+    def stats(self):
+        """ストアの利用状況を取得"""
+        entries, total_bytes = 0, 0
+        if self.enabled:
+            try:
+                entries, total_bytes = self._connection().execute(
+                    'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM subquery_results'
+                ).fetchone()
+            except sqlite3.Error:
+                pass
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'enabled': self.enabled,
+                'corpus_key': self.corpus_key,
+                'entries': entries,
+                'bytes': total_bytes,
+                'max_bytes': self.max_bytes,
+                'warm_entries': len(self._warm),
+                'hits': self._hits,
+                'warm_hits': self._warm_hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+                'writes': self._writes,
+                'evictions': self._evictions,
+                'errors': self._errors,
+            }
+
+subquery_store = SubqueryStore(SUBQUERY_STORE_PATH, SUBQUERY_STORE_MAX_BYTES, SUBQUERY_STORE_WARM_ENTRIES)
+with startup_profile.phase('subquery_store'):
+    subquery_store.warm_start()
+os.register_at_fork(after_in_child=subquery_store.after_fork)
+
+# ファイル名中の日付（_yyyymmdd形式、または前後が数字以外のyyyymmdd形式）
+SOURCE_DATE_PATTERNS = (
+    re.compile(r'_(\d{8})(?:\.|_|$)'),
+    re.compile(r'(?:^|[^\d])(\d{8})(?:[^\d]|$)'),
+)
+# 日付が見つからない出典は最も古いものとして扱う
+OLDEST_SOURCE_DATE = datetime(1900, 1, 1)
+
+@lru_cache(maxsize=16384)
 def extract_date_from_filename(filename):
-    """ファイル名から日付を抽出する（_yyyymmdd形式またはyyyymmdd形式）"""
+    """ファイル名から日付を抽出する（_yyyymmdd形式またはyyyymmdd形式、結果はキャッシュ）"""
     if not filename:
         return None
     
-    # yyyymmdd形式の日付を検索（アンダースコアありまたはなし）
-    # パターン1: _yyyymmdd形式（アンダースコアあり）
-    # パターン2: yyyymmdd形式（ファイル名の先頭または区切り文字の後）
-    date_patterns = [
-        r'_(\d{8})(?:\.|_|$)',  # _yyyymmdd形式
-        r'(?:^|[^\d])(\d{8})(?:[^\d]|$)',  # yyyymmdd形式（前後に数字以外の文字）
-    ]
-    
-    for pattern in date_patterns:
-        match = re.search(pattern, filename)
+    for pattern in SOURCE_DATE_PATTERNS:
+        match = pattern.search(filename)
         if match:
             date_str = match.group(1)
             try:
@@ -304,106 +1606,127 @@ def extract_date_from_filename(filename):
     
     return None
 
-def sort_sources_by_date(sources):
-    """出典情報を日付順にソート（新しい日付を優先）"""
-    def get_sort_key(source):
-        title = source.get('title', '')
-        uri = source.get('uri', '')
-        
-        # タイトルとURIの両方から日付を抽出を試みる
-        date_from_title = extract_date_from_filename(title)
-        date_from_uri = extract_date_from_filename(uri)
-        
-        # より新しい日付を使用
-        extracted_date = None
-        if date_from_title and date_from_uri:
-            extracted_date = max(date_from_title, date_from_uri)
-        elif date_from_title:
-            extracted_date = date_from_title
-        elif date_from_uri:
-            extracted_date = date_from_uri
-        
-        # 日付が見つからない場合は最も古い日付として扱う
-        if extracted_date is None:
-            extracted_date = datetime(1900, 1, 1)
-        
+class SourceRecord:
+    """出典1件分のタイトル・URIと、並べ替え用のキー
+    
+    日付の抽出は作成時に一度だけ行い、回答ごとの出典一覧・重複排除・最終的なメタデータで使い回す。
+    """
+    
+    __slots__ = ('title', 'uri', 'sort_key')
+    
+    def __init__(self, title, uri):
+        self.title = title
+        self.uri = uri
+        # タイトルとURIの両方から日付を抽出し、より新しい日付を使用
+        dates = [date for date in (extract_date_from_filename(title), extract_date_from_filename(uri)) if date]
+        newest = max(dates) if dates else OLDEST_SOURCE_DATE
         # 新しい日付を優先するため、日付を逆順でソート
-        return (-extracted_date.timestamp(), title.lower())
+        self.sort_key = (-newest.timestamp(), (title or '').lower())
+    
+    @classmethod
+    def from_dict(cls, source):
+        return cls(source.get('title'), source.get('uri'))
+    
+    @property
+    def date_label(self):
+        """表示用の日付（タイトルに日付がなければ空文字列）"""
+        date = extract_date_from_filename(self.title)
+        return f" ({date.strftime('%Y-%m-%d')})" if date else ""
+    
+    def to_dict(self, default_title=None):
+        source = {}
+        if self.title or default_title:
+            source['title'] = self.title or default_title
+        if self.uri:
+            source['uri'] = self.uri
+        return source
+
+def sort_source_records(records):
+    """出典を日付順にソート（新しい日付を優先）"""
+    return sorted(records, key=lambda record: record.sort_key)
+
+def get_source_records(converted_metadata):
+    """変換済みグラウンディングメタデータから日付順の出典を取得"""
+    if not converted_metadata or 'grounding_chunks' not in converted_metadata:
+        return []
+    return sort_source_records(SourceRecord.from_dict(chunk) for chunk in converted_metadata['grounding_chunks'])
+
+def get_grounding_chunk_source(chunk):
+    """グラウンディングチャンクから (title, uri) を取得（retrieved_context・web・直接の属性の順）"""
+    title = uri = None
+    retrieved_context = getattr(chunk, 'retrieved_context', None)
+    if retrieved_context:
+        title = getattr(retrieved_context, 'title', None)
+        uri = getattr(retrieved_context, 'uri', None)
     
-    return sorted(sources, key=get_sort_key)
+    # webプロパティも確認（念のため）
+    if not (title and uri):
+        web = getattr(chunk, 'web', None)
+        if web:
+            title = title or getattr(web, 'title', None)
+            uri = uri or getattr(web, 'uri', None)
+    
+    return title or getattr(chunk, 'title', None), uri or getattr(chunk, 'uri', None)
 
+@traced('convert_metadata')
 def convert_grounding_metadata_to_dict(grounding_metadata):
-    """グラウンディングメタデータを辞書形式に変換"""
+    """グラウンディングメタデータを辞書形式に変換（出典は日付順）"""
     if grounding_metadata is None:
         return None
     
     try:
-        grounding_chunks = grounding_metadata.grounding_chunks
-        
-        unsorted_chunks = []
-        for i, chunk in enumerate(grounding_chunks):
-            chunk_dict = {}
-            
-            # 基本情報を取得
-            if hasattr(chunk, 'retrieved_context') and chunk.retrieved_context:
-                retrieved_context = chunk.retrieved_context
-                
-                # titleを取得
-                if hasattr(retrieved_context, 'title') and retrieved_context.title:
-                    chunk_dict['title'] = retrieved_context.title
-                
-                # uriを取得
-                if hasattr(retrieved_context, 'uri') and retrieved_context.uri:
-                    chunk_dict['uri'] = retrieved_context.uri
-            
-            # webプロパティも確認（念のため）
-            if hasattr(chunk, 'web') and chunk.web:
-                if not chunk_dict.get('title') and hasattr(chunk.web, 'title'):
-                    chunk_dict['title'] = chunk.web.title
-                if not chunk_dict.get('uri') and hasattr(chunk.web, 'uri'):
-                    chunk_dict['uri'] = chunk.web.uri
-            
-            # 直接的なtitle/uriプロパティも確認
-            if not chunk_dict.get('title') and hasattr(chunk, 'title'):
-                chunk_dict['title'] = chunk.title
-            if not chunk_dict.get('uri') and hasattr(chunk, 'uri'):
-                chunk_dict['uri'] = chunk.uri
-            
-            unsorted_chunks.append(chunk_dict)
-        
-        # 日付でソート
-        sorted_chunks = sort_sources_by_date(unsorted_chunks)
-        
-        result = {
-            'grounding_chunks': sorted_chunks
+        records = [
+            SourceRecord(*get_grounding_chunk_source(chunk))
+            for chunk in grounding_metadata.grounding_chunks or []
+        ]
+        return {
+            'grounding_chunks': [record.to_dict() for record in sort_source_records(records)]
         }
         
-        return result
-        
     except Exception as e:
         return None
 
-def generate_plan_and_questions(user_message):
-    """ユーザーの質問から計画と関連質問を生成"""
-    try:
-        client = create_rag_client()
-        
+def format_plan(plan, questions):
+    """調査計画と関連質問リストを表示用のMarkdownに整形"""
+    question_lines = '\n'.join(f"{i}. {question}" for i, question in enumerate(questions, 1))
+    return f"""
+## 調査計画
+{plan}
+
+## 関連質問リスト
+{question_lines}
+"""
+
+def parse_plan_response(text):
+    """計画立案のJSON応答を検証し、(調査計画, 関連質問リスト) を返す（不正な場合はNone）"""
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get('questions'), list):
+        return None
+    
+    plan = data.get('plan')
+    questions = []
+    for question in data['questions']:
+        if isinstance(question, str) and question.strip() and question.strip() not in questions:
+            questions.append(question.strip())
+    return (plan.strip() if isinstance(plan, str) else ''), questions[:5]
+
+async def generate_plan_and_questions(user_message):
+    """ユーザーの質問から計画と関連質問を生成
+    
+    (表示用の計画テキスト, 関連質問リスト) を返す。生成できなかった部分はデフォルトで補う。
+    """
+    try:
         planning_prompt = f"""
 以下のユーザーの質問に対して、包括的で詳細な回答を提供するための計画を立ててください。
 
 ユーザーの質問: {user_message}
 
-以下の形式で回答してください：
-
-## 調査計画
-[この質問に答えるための調査計画を簡潔に説明]
-
-## 関連質問リスト
-1. [関連質問1]
-2. [関連質問2]
-3. [関連質問3]
-4. [関連質問4]
-5. [関連質問5]
+以下のJSON形式で回答してください：
+- plan: この質問に答えるための調査計画（簡潔に）
+- questions: 関連質問5つ
 
 関連質問は以下の観点から作成してください：
 - "製品含有化学物質管理"の文脈
@@ -423,64 +1746,302 @@ def generate_plan_and_questions(user_message):
             )
         ]
         
-        config = create_generate_config(temperature=0.7, include_tools=False)
+        config = get_generate_config('planning')
         
-        response = client.models.generate_content(
+        started_at = time.monotonic()
+        response = await upstream_gateway.generate_content(
+            'planning',
             model=GEMINI_MODEL,
             contents=contents,
             config=config,
         )
+        stage_latency.record('planning', None, time.monotonic() - started_at)
         
-        if response and response.text:
-            return response.text
-        else:
-            print("WARNING: Empty response from planning model")
-            return f"""
-## 調査計画
-{user_message}について詳細に調査します。
-
-## 関連質問リスト
-1. {user_message}の基本的な定義とは何ですか？
-2. {user_message}の具体的な事例を教えてください
-3. {user_message}のメリットとデメリットは何ですか？
-4. {user_message}の最新の動向はどうですか？
-5. {user_message}に関連する技術や手法はありますか？
-"""
+        parsed = parse_plan_response(response.text) if response else None
+        if parsed is None:
+            print("WARNING: Empty or invalid response from planning model")
+            return generate_default_plan_and_questions(user_message)
+        
+        plan, questions = parsed
+        # 質問が少ない場合はデフォルトの関連質問で補う（計画立案の結果は捨てない）
+        for question in generate_default_questions(user_message):
+            if len(questions) >= 3:
+                break
+            if question not in questions:
+                questions.append(question)
+        
+        return format_plan(plan or f"{user_message}について詳細に調査します。", questions), questions
+    except asyncio.CancelledError:
+        cancelled_work.inc('planning')
+        raise
     except Exception as e:
         print(f"Error in generate_plan_and_questions: {e}")
-        return f"""
-## 調査計画
-{user_message}について詳細に調査します。
-
-## 関連質問リスト
-1. {user_message}の基本的な定義とは何ですか？
-2. {user_message}の具体的な事例を教えてください
-3. {user_message}のメリットとデメリットは何ですか？
-4. {user_message}の最新の動向はどうですか？
-5. {user_message}に関連する技術や手法はありますか？
-"""
+        return generate_default_plan_and_questions(user_message)
 
 def generate_default_plan_and_questions(user_message):
     """デフォルトの計画と関連質問を生成"""
-    return f"""
-## 調査計画
-{user_message}について詳細に調査します。
+    questions = generate_default_questions(user_message)
+    return format_plan(f"{user_message}について詳細に調査します。", questions), questions
 
-## 関連質問リスト
-1. {user_message}の基本的な定義とは何ですか？
-2. {user_message}の具体的な事例を教えてください
-3. {user_message}のメリットとデメリットは何ですか？
-4. {user_message}の最新の動向はどうですか？
-5. {user_message}に関連する技術や手法はありますか？
-"""
+def format_metric_labels(labels):
+    """Prometheusのラベル表記（{name="value",...}）に整形"""
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+class MetricCounter:
+    """ラベルごとに値を積算するPrometheusのカウンター"""
+    
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._values = {}
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{format_metric_labels(zip(self.label_names, key))} {value}')
+        return lines
+
+class MetricHistogram:
+    """ラベルごとに累積バケットを保持するPrometheusのヒストグラム"""
+    
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}  # ラベル -> [バケットごとの件数, 合計, 件数]
+    
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (bucket_counts, total, count) in sorted(self._values.items()):
+                labels = list(zip(self.label_names, key))
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f'{self.name}_bucket{format_metric_labels(labels + [("le", bound)])} {bucket_count}')
+                lines.append(f'{self.name}_bucket{format_metric_labels(labels + [("le", "+Inf")])} {count}')
+                lines.append(f'{self.name}_sum{format_metric_labels(labels)} {total}')
+                lines.append(f'{self.name}_count{format_metric_labels(labels)} {count}')
+        return lines
+
+# 処理時間のヒストグラムのバケット（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
 
-def execute_single_rag_query(question):
-    """単一のRAGクエリを実行"""
+stage_duration_histogram = MetricHistogram(
+    'cmp_chat_stage_duration_seconds', '処理段階ごとの所要時間', ('stage',), LATENCY_BUCKETS
+)
+stage_ttfb_histogram = MetricHistogram(
+    'cmp_chat_stage_ttfb_seconds', '処理段階ごとの最初の出力までの時間', ('stage',), LATENCY_BUCKETS
+)
+upstream_errors_counter = MetricCounter(
+    'cmp_chat_upstream_errors_total', '上流呼び出しのエラー件数（再試行を含む）', ('operation', 'type')
+)
+upstream_tokens_counter = MetricCounter(
+    'cmp_chat_upstream_tokens_total', '上流呼び出しのトークン数（usage_metadataより）', ('operation', 'kind')
+)
+stream_compression_input_counter = MetricCounter(
+    'cmp_chat_stream_compression_input_bytes_total', '/chatの圧縮前のバイト数', ('encoding',)
+)
+stream_compression_output_counter = MetricCounter(
+    'cmp_chat_stream_compression_output_bytes_total', '/chatの圧縮後のバイト数', ('encoding',)
+)
+stream_compression_cpu_counter = MetricCounter(
+    'cmp_chat_stream_compression_cpu_seconds_total', '/chatの圧縮に使ったCPU時間（秒）', ('encoding',)
+)
+stream_frames_counter = MetricCounter(
+    'cmp_chat_stream_frames_total', '/chatで送信したフレーム数（ストリーム形式ごと）', ('format',)
+)
+stream_bytes_counter = MetricCounter(
+    'cmp_chat_stream_bytes_total', '/chatで送信したバイト数（ストリーム形式ごと）', ('format',)
+)
+
+def record_usage_metadata(operation, usage_metadata):
+    """応答のusage_metadataからプロンプト・出力・思考のトークン数を記録"""
+    if usage_metadata is None:
+        return
+    for kind, field in (('prompt', 'prompt_token_count'), ('output', 'candidates_token_count'), ('thinking', 'thoughts_token_count')):
+        count = getattr(usage_metadata, field, None)
+        if count:
+            upstream_tokens_counter.inc(count, operation=operation, kind=kind)
+
+def get_upstream_error_type(error):
+    """エラー件数の集計に使う種類（ステータス名、HTTPステータスコード、または例外クラス名）"""
+    if isinstance(error, UPSTREAM_ERRORS):
+        code, status = get_upstream_error_code(error)
+        return status or str(code)
+    return type(error).__name__
+
+class StageLatencyRecorder:
+    """処理段階ごとに最初の出力までの時間（TTFB）と全体の所要時間を集計
+    
+    /admin/stats用の平均・最大値に加え、/metrics用のヒストグラムにも記録する。
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+    
+    def record(self, stage, ttfb, total):
+        """1回分の計測結果を記録（出力がなかった場合ttfbはNone）"""
+        stage_duration_histogram.observe(total, stage=stage)
+        if ttfb is not None:
+            stage_ttfb_histogram.observe(ttfb, stage=stage)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add_span(
+                stage, time.monotonic() - total, total,
+                ttfb_ms=round(ttfb * 1000, 1) if ttfb is not None else None
+            )
+        with self._lock:
+            entry = self._stages.setdefault(stage, {
+                'count': 0, 'ttfb_count': 0, 'ttfb_sum': 0.0, 'ttfb_max': 0.0, 'total_sum': 0.0, 'total_max': 0.0,
+            })
+            entry['count'] += 1
+            entry['total_sum'] += total
+            entry['total_max'] = max(entry['total_max'], total)
+            if ttfb is not None:
+                entry['ttfb_count'] += 1
+                entry['ttfb_sum'] += ttfb
+                entry['ttfb_max'] = max(entry['ttfb_max'], ttfb)
+    
+    def stats(self):
+        """段階ごとの平均・最大値（秒）を取得"""
+        with self._lock:
+            return {
+                stage: {
+                    'count': entry['count'],
+                    'ttfb_avg': entry['ttfb_sum'] / entry['ttfb_count'] if entry['ttfb_count'] else None,
+                    'ttfb_max': entry['ttfb_max'],
+                    'total_avg': entry['total_sum'] / entry['count'],
+                    'total_max': entry['total_max'],
+                }
+                for stage, entry in self._stages.items()
+            }
+
+stage_latency = StageLatencyRecorder()
+
+class WorkCounter:
+    """種類ごとの件数を数えるスレッドセーフなカウンター"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+    
+    def inc(self, kind, amount=1):
+        if amount:
+            with self._lock:
+                self._counts[kind] = self._counts.get(kind, 0) + amount
+    
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
+
+# クライアント切断や制限時間超過により中止した処理の件数（/metricsでは件数が0の種類も出力する）
+cancelled_work = WorkCounter()
+CANCELLED_WORK_KINDS = ('planning', 'subquery', 'synthesis', 'response', 'stream')
+
+# 深掘りモードの制限時間による打ち切りと重複実行（ヘッジ）の件数
+deadline_events = WorkCounter()
+
+# 共有検索ステージの実行・重複排除の件数
+retrieval_stats = WorkCounter()
+
+# 包括的な回答のプロンプト圧縮による入力トークン数（概算）の削減量
+synthesis_prompt_stats = WorkCounter()
+
+def resolve_deadline_seconds(requested=None):
+    """リクエストで指定された制限時間を検証し、未指定・不正な場合は既定値を返す"""
+    if isinstance(requested, bool) or not isinstance(requested, (int, float)) or not requested > 0:
+        return DEEP_MODE_DEADLINE_SECONDS
+    return min(float(requested), DEEP_MODE_MAX_DEADLINE_SECONDS)
+
+class DeadlineBudget:
+    """深掘りモード1リクエスト分の制限時間を計画・関連質問・統合の各段階に配分する
+    
+    各メソッドは段階に使える残り秒数を返す（制限時間なしの場合はNone）。
+    """
+    
+    def __init__(self, total_seconds, planning_share=DEEP_MODE_PLANNING_SHARE, synthesis_share=DEEP_MODE_SYNTHESIS_SHARE):
+        self.total_seconds = total_seconds
+        self.planning_share = planning_share
+        self.synthesis_share = synthesis_share
+        self.started_at = time.monotonic()
+    
+    def _remaining(self, reserve_share=0.0):
+        if not self.total_seconds:
+            return None
+        end = self.started_at + self.total_seconds * (1 - reserve_share)
+        return max(0.0, end - time.monotonic())
+    
+    def planning_timeout(self):
+        if not self.total_seconds:
+            return None
+        return min(self._remaining(), self.total_seconds * self.planning_share)
+    
+    def subquery_timeout(self):
+        return self._remaining(self.synthesis_share)
+    
+    def synthesis_timeout(self):
+        return self._remaining()
+
+async def iterate_with_deadline(async_iterable, deadline):
+    """期限（time.monotonic()基準、Noneで無期限）までに届いた要素をyieldし、過ぎたらTimeoutErrorを送出"""
+    iterator = aiter(async_iterable)
+    while True:
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            item = await asyncio.wait_for(anext(iterator), timeout)
+        except StopAsyncIteration:
+            return
+        yield item
+
+def get_chunk_text(chunk):
+    """ストリーミングのチャンクからテキストを取得（テキストがなければ空文字）"""
+    if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+        return ''
+    return chunk.text or ''
+
+async def execute_single_rag_query(question, on_delta=None, contexts=None):
+    """単一のRAGクエリを実行
+    
+    on_deltaを指定すると、回答の断片を受信するたびにテキストを渡して呼び出す。
+    contexts（共有検索ステージの検索結果）を指定すると、検索ツールを使わずプロンプトに埋め込んで回答させ、
+    グラウンディングメタデータも検索結果から作成する。
+    """
     try:
-        client = create_rag_client()
-        
         # システムプロンプトをユーザーメッセージに統合
-        combined_message = f"{RAG_SYSTEM_PROMPT}\n\n質問: {question}"
+        if contexts is None:
+            combined_message = f"{RAG_SYSTEM_PROMPT}\n\n質問: {question}"
+            config = get_generate_config('subquery')
+        else:
+            combined_message = f"{RAG_SYSTEM_PROMPT}\n\nRAG検索結果:\n{format_contexts(contexts)}\n\n質問: {question}"
+            config = get_generate_config('subquery_inline')
         
         contents = [
             types.Content(
@@ -489,30 +2050,288 @@ def execute_single_rag_query(question):
             )
         ]
         
-        config = create_generate_config()
+        answer_text = ''
+        grounding_metadata = None
+        started_at = time.monotonic()
+        ttfb = None
         
-        response = client.models.generate_content(
+        async with aclosing(upstream_gateway.generate_content_stream(
+            'subquery',
             model=GEMINI_MODEL,
             contents=contents,
             config=config,
-        )
+        )) as stream:
+            async for chunk in stream:
+                text = get_chunk_text(chunk)
+                if text:
+                    if ttfb is None:
+                        ttfb = time.monotonic() - started_at
+                    answer_text += text
+                    if on_delta:
+                        on_delta(text)
+                
+                # グラウンディングメタデータを取得（最後に見つかったものを使用）
+                grounding_metadata = extract_grounding_metadata(chunk) or grounding_metadata
         
-        # グラウンディングメタデータを取得
-        grounding_metadata = extract_grounding_metadata(response)
+        stage_latency.record('subquery', ttfb, time.monotonic() - started_at)
         
-        answer_text = response.text if response and response.text else "回答を取得できませんでした。"
+        if contexts is not None:
+            grounding_metadata = build_grounding_metadata(contexts) if contexts else None
+        
+        if not answer_text:
+            answer_text = "回答を取得できませんでした。"
         return answer_text, grounding_metadata
         
+    except UpstreamOverloadedError:
+        # 「情報が見つからない」と区別できるよう、クォータ超過は例外のまま呼び出し側へ伝える
+        raise
     except Exception as e:
         return handle_rag_error(e, "execute_single_rag_query"), None
 
-def synthesize_comprehensive_answer(user_message, plan_text, qa_results):
-    """計画と各質問の回答を統合して包括的な回答を生成"""
-    client = create_rag_client()
+def is_failed_answer(answer):
+    """回答が空、またはエラーメッセージかどうかを判定"""
+    return not answer or "エラー" in answer or "取得できません" in answer
+
+async def execute_stored_rag_query(question, on_delta=None, contexts=None):
+    """サブクエリ結果ストアを参照し、なければRAGクエリを実行して保存
+    
+    (回答, 変換済みグラウンディングメタデータ) を返す。ストアにある場合、on_deltaは呼ばれない。
+    """
+    # SQLiteへのアクセスはイベントループを止めないよう別スレッドで行う
+    stored = await asyncio.to_thread(subquery_store.get, question, contexts)
+    if stored is not None:
+        return stored
+    
+    answer, grounding_metadata = await execute_single_rag_query(question, on_delta=on_delta, contexts=contexts)
+    converted_metadata = convert_grounding_metadata_to_dict(grounding_metadata) if grounding_metadata else None
+    
+    if not is_failed_answer(answer):
+        await asyncio.to_thread(subquery_store.put, question, answer, converted_metadata, contexts)
+    
+    return answer, converted_metadata
+
+def is_successful_query_task(task):
+    """RAGクエリのタスクが中止・例外・エラーの回答なしに完了したかを判定"""
+    return not task.cancelled() and task.exception() is None and not is_failed_answer(task.result()[0])
+
+async def execute_hedged_rag_query(question, on_delta=None, hedge_delay=None, contexts=None):
+    """hedge_delay秒経っても回答が届き始めなければ同じ質問を重複実行し、先に成功した方を返す
+    
+    重複実行した側の回答の断片は送らない。
+    """
+    if not hedge_delay:
+        return await execute_stored_rag_query(question, on_delta=on_delta, contexts=contexts)
+    
+    started = False
+    def on_primary_delta(text):
+        nonlocal started
+        started = True
+        if on_delta:
+            on_delta(text)
+    
+    primary = asyncio.create_task(execute_stored_rag_query(question, on_delta=on_primary_delta, contexts=contexts))
+    tasks = {primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+        if done or started:
+            return await primary
+        
+        deadline_events.inc('hedge_launched')
+        tasks.add(asyncio.create_task(execute_stored_rag_query(question, contexts=contexts)))
+        while True:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            succeeded = [task for task in done if is_successful_query_task(task)]
+            if succeeded:
+                if primary not in succeeded:
+                    deadline_events.inc('hedge_won')
+                return succeeded[0].result()
+            # 失敗した側は採用せず、残りのタスクがなくなった場合のみ失敗を返す
+            if not tasks:
+                return done.pop().result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def run_rag_queries_concurrently(questions, max_workers=None, timeout=None, hedge_delay=None, prefetched=None, retrieval=None):
+    """複数のRAGクエリを並列実行し、回答の断片と完了した結果を到着順に返す
+    
+    prefetchedには先行実行中の質問番号 -> (回答, 変換済みメタデータ) を返すタスクを渡す。
+    retrieval（SharedRetrieval）を指定すると、検索ツールを使わず共有検索ステージの検索結果で回答する。
+    以下のタプルを順次yieldする（質問番号は1始まり）：
+    - ('delta', 質問番号, 回答の断片)
+    - ('result', 質問番号, 質問, 回答, 変換済みグラウンディングメタデータ, 例外)
+    - ('dropped', 質問番号, 質問)：timeout秒以内に完了せず破棄した質問（最後にまとめて返す）
+    """
+    if not questions:
+        return
+    
+    semaphore = asyncio.Semaphore(max_workers or DEEP_MODE_MAX_PARALLEL)
+    updates = asyncio.Queue()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    
+    prefetched = prefetched or {}
+    
+    async def run_query(i, question):
+        try:
+            if i in prefetched:
+                # 先行実行の結果を待つ（同時実行数には数えない）
+                answer, converted_metadata = await prefetched[i]
+            else:
+                async with semaphore:
+                    answer, converted_metadata = await execute_hedged_rag_query(
+                        question,
+                        on_delta=lambda text: updates.put_nowait(('delta', i, text)),
+                        hedge_delay=hedge_delay,
+                        contexts=retrieval.contexts_for_question(question) if retrieval else None
+                    )
+            updates.put_nowait(('result', i, question, answer, converted_metadata, None))
+        except Exception as e:
+            updates.put_nowait(('result', i, question, None, None, e))
+    
+    tasks = [
+        asyncio.create_task(run_query(i, question))
+        for i, question in enumerate(questions, 1)
+    ]
+    completed = set()
+    try:
+        while len(completed) < len(tasks):
+            try:
+                update = updates.get_nowait()
+            except asyncio.QueueEmpty:
+                try:
+                    update = await asyncio.wait_for(
+                        updates.get(),
+                        None if deadline is None else max(0.0, deadline - time.monotonic())
+                    )
+                except TimeoutError:
+                    # 制限時間内に完了しなかった質問は破棄する
+                    for i, question in enumerate(questions, 1):
+                        if i not in completed:
+                            yield ('dropped', i, question)
+                    return
+            if update[0] == 'result':
+                completed.add(update[1])
+            yield update
+    finally:
+        # 呼び出し側が途中で終了した場合も未完了のクエリは破棄する
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        cancelled_work.inc('subquery', len(pending))
+
+def question_bigrams(question):
+    """類似度計算用に、正規化した質問文の文字bigramの集合を作成"""
+    normalized = normalize_question(question)
+    return {normalized[i:i + 2] for i in range(len(normalized) - 1)} or {normalized}
+
+def question_similarity(a, b):
+    """2つの質問の類似度（文字bigramのJaccard係数、0〜1）"""
+    a_grams = question_bigrams(a)
+    b_grams = question_bigrams(b)
+    return len(a_grams & b_grams) / len(a_grams | b_grams)
+
+class SpeculationRecorder:
+    """先行実行の件数・再利用率・短縮できた待ち時間を集計"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._launched = 0
+        self._hits = 0
+        self._misses = 0
+        self._saved_sum = 0.0
+        self._saved_max = 0.0
+    
+    def record_launch(self, count):
+        with self._lock:
+            self._launched += count
     
-    qa_text = "\n\n".join([f"**Q: {q}**\nA: {a}" for q, a in qa_results])
+    def record_hit(self, saved_seconds):
+        with self._lock:
+            self._hits += 1
+            self._saved_sum += saved_seconds
+            self._saved_max = max(self._saved_max, saved_seconds)
     
-    synthesis_prompt = f"""
+    def record_miss(self, count):
+        with self._lock:
+            self._misses += count
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'launched': self._launched,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / self._launched if self._launched else 0.0,
+                'latency_saved_sum': self._saved_sum,
+                'latency_saved_avg': self._saved_sum / self._hits if self._hits else 0.0,
+                'latency_saved_max': self._saved_max,
+            }
+
+speculation_stats = SpeculationRecorder()
+
+class SpeculativePrefetch:
+    """関連質問の生成と並行して候補の質問を先行実行し、計画された質問と一致したものを再利用する
+    
+    使われなかった先行実行はcancel()で中止する。
+    """
+    
+    def __init__(self, questions):
+        self.started_at = time.monotonic()
+        self._pending = {question: asyncio.create_task(self._run(question)) for question in questions}
+        self._reused = []
+        speculation_stats.record_launch(len(self._pending))
+    
+    async def _run(self, question):
+        started_at = time.monotonic()
+        result = await execute_stored_rag_query(question)
+        return result, time.monotonic() - started_at
+    
+    async def _reuse(self, task, elapsed):
+        result, duration = await task
+        # 計画完了時点で既に進んでいた分だけ待ち時間が短縮される
+        speculation_stats.record_hit(min(duration, elapsed))
+        return result
+    
+    def assign(self, questions, threshold=DEEP_MODE_SPECULATION_MATCH_THRESHOLD):
+        """計画された質問に先行実行を割り当てる
+        
+        類似度が閾値以上の組を類似度の高い順に割り当て、割り当てた質問は先行実行した質問文に置き換える。
+        (質問リスト, 質問番号 -> 結果を返すタスク) を返す。
+        """
+        elapsed = time.monotonic() - self.started_at
+        questions = list(questions)
+        prefetched = {}
+        pairs = sorted(
+            ((question_similarity(question, candidate), i, candidate)
+             for i, question in enumerate(questions, 1)
+             for candidate in self._pending),
+            reverse=True,
+        )
+        for score, i, candidate in pairs:
+            if score < threshold:
+                break
+            if i in prefetched or candidate not in self._pending:
+                continue
+            questions[i - 1] = candidate
+            task = asyncio.create_task(self._reuse(self._pending.pop(candidate), elapsed))
+            self._reused.append(task)
+            prefetched[i] = task
+        return questions, prefetched
+    
+    def cancel(self):
+        """割り当てられなかった先行実行を中止（割り当て済みで未完了のものも中止）"""
+        for task in self._pending.values():
+            if task.done() and not task.cancelled():
+                task.exception()
+            task.cancel()
+        speculation_stats.record_miss(len(self._pending))
+        self._pending.clear()
+        for task in self._reused:
+            task.cancel()
+
+def build_synthesis_prompt(user_message, plan_text, qa_text, contexts_section="", sources_section=""):
+    """包括的な回答を作成するためのプロンプトを組み立てる"""
+    return f"""
 以下の情報を基に、ユーザーの質問に対する包括的で詳細な回答を作成してください。
 
 **重要**: 以下の調査結果のみを使用して回答してください。あなたの一般的な知識や事前学習データは一切使用しないでください。
@@ -524,7 +2343,7 @@ def synthesize_comprehensive_answer(user_message, plan_text, qa_results):
 
 関連質問と回答:
 {qa_text}
-
+{contexts_section}{sources_section}
 以下の要件に従って回答を作成してください：
 1. 元の質問に直接答える
 2. 関連質問の回答から得られた情報のみを統合する
@@ -543,6 +2362,169 @@ def synthesize_comprehensive_answer(user_message, plan_text, qa_results):
 - 最新動向・課題
 - まとめ
 """
+
+# 文の分割と重複判定（MinHash）の設定
+SENTENCE_PATTERN = re.compile(r'[^。！？!?]+[。！？!?]*')
+SHINGLE_SIZE = 4
+MINHASH_SIZE = 32
+SYNTHESIS_DEDUP_MIN_CHARS = 12
+
+def estimate_tokens(text):
+    """トークン数の概算（ASCII文字は4文字、それ以外は1文字を1トークンとみなす）"""
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return len(text) - ascii_chars + (ascii_chars + 3) // 4
+
+def split_sentences(text):
+    """テキストを文に分割し、(文, 行末かどうか) のリストを返す（空行は空文字）"""
+    segments = []
+    for line in text.split('\n'):
+        sentences = [sentence.strip() for sentence in SENTENCE_PATTERN.findall(line) if sentence.strip()]
+        if not sentences:
+            segments.append(('', True))
+        for i, sentence in enumerate(sentences, 1):
+            segments.append((sentence, i == len(sentences)))
+    return segments
+
+def join_sentences(segments):
+    """split_sentencesで分割した文を結合"""
+    text = ''.join(sentence + ('\n' if line_end else '') for sentence, line_end in segments)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+def minhash_signature(text):
+    """文字shingleのMinHash（ハッシュ値の小さい方からMINHASH_SIZE個）を作成"""
+    normalized = re.sub(r'\s+', '', unicodedata.normalize('NFKC', text).lower())
+    shingles = {normalized[i:i + SHINGLE_SIZE] for i in range(max(1, len(normalized) - SHINGLE_SIZE + 1))}
+    return frozenset(heapq.nsmallest(MINHASH_SIZE, {hash(shingle) for shingle in shingles}))
+
+def estimate_similarity(a, b):
+    """2つのMinHashからJaccard係数を推定"""
+    union = heapq.nsmallest(MINHASH_SIZE, a | b)
+    if not union:
+        return 0.0
+    return sum(1 for value in union if value in a and value in b) / len(union)
+
+class NearDuplicateFilter:
+    """既出の文・段落とほぼ同じ内容かどうかをMinHashで判定する"""
+    
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._signatures = []
+    
+    def seen(self, text):
+        """既出と類似していればTrue、そうでなければ記録してFalseを返す"""
+        signature = minhash_signature(text)
+        if any(estimate_similarity(signature, kept) >= self.threshold for kept in self._signatures):
+            return True
+        self._signatures.append(signature)
+        return False
+
+def compress_synthesis_inputs(qa_results, contexts, source_titles, token_budget):
+    """統合用の入力（関連質問の回答・検索結果）を重複除去し、トークン数の上限に収める
+    
+    回答間でほぼ同じ文は最初の1つだけを残す。ただし、まだ引用されていない出典名を含む文は残す。
+    上限を超える場合は各回答の先頭から順に1文ずつ交互に残し、検索結果は残りの枠に収まる分だけ残す。
+    (回答リスト, 検索結果, 集計) を返す。
+    """
+    counts = {'duplicates': 0, 'trimmed': 0, 'contexts_dropped': 0}
+    sentence_filter = NearDuplicateFilter(SYNTHESIS_DEDUP_THRESHOLD)
+    cited = set()
+    
+    answers = []
+    for question, answer in qa_results:
+        kept = []
+        for sentence, line_end in split_sentences(answer):
+            if len(sentence) >= SYNTHESIS_DEDUP_MIN_CHARS:
+                new_citations = {title for title in source_titles if title in sentence} - cited
+                if sentence_filter.seen(sentence) and not new_citations:
+                    counts['duplicates'] += 1
+                    continue
+                cited |= new_citations
+            kept.append((sentence, line_end))
+        answers.append((question, kept))
+    
+    context_filter = NearDuplicateFilter(SYNTHESIS_DEDUP_THRESHOLD)
+    unique_contexts = []
+    for context in contexts or []:
+        if context_filter.seen(context['text']):
+            counts['contexts_dropped'] += 1
+        else:
+            unique_contexts.append(context)
+    
+    # 検索結果がある場合は、上限の半分までを検索結果用に確保する
+    qa_tokens = [[estimate_tokens(sentence) + 1 for sentence, _ in kept] for _, kept in answers]
+    context_tokens = [estimate_tokens(context['text']) + estimate_tokens(context['title']) + 4 for context in unique_contexts]
+    reserved = min(sum(context_tokens), token_budget // 2)
+    
+    remaining = token_budget - reserved
+    taken = [0] * len(answers)
+    progressed = True
+    while progressed:
+        progressed = False
+        for i, tokens in enumerate(qa_tokens):
+            if taken[i] < len(tokens) and tokens[taken[i]] <= remaining:
+                remaining -= tokens[taken[i]]
+                taken[i] += 1
+                progressed = True
+    
+    compressed_results = []
+    for (question, kept), count in zip(answers, taken):
+        counts['trimmed'] += len(kept) - count
+        answer = join_sentences(kept[:count])
+        if count < len(kept):
+            answer += '\n（以下省略）'
+        compressed_results.append((question, answer))
+    
+    remaining += reserved
+    kept_contexts = []
+    for context, tokens in zip(unique_contexts, context_tokens):
+        if tokens > remaining:
+            counts['contexts_dropped'] += len(unique_contexts) - len(kept_contexts)
+            break
+        remaining -= tokens
+        kept_contexts.append(context)
+    
+    return compressed_results, (kept_contexts if contexts is not None else None), counts
+
+async def synthesize_comprehensive_answer(user_message, plan_text, qa_results, timeout=None, contexts=None, source_titles=()):
+    """計画と各質問の回答を統合して包括的な回答を生成
+    
+    回答テキストを受信した断片ごとにyieldする。timeout秒を過ぎた場合はそこで打ち切る。
+    contexts（共有検索ステージの検索結果）を指定すると、検索ツールを使わずプロンプトに埋め込む。
+    source_titles（回答の出典名）はプロンプトに列挙し、圧縮時も引用している文を残す。
+    """
+    original_qa_text = "\n\n".join([f"**Q: {q}**\nA: {a}" for q, a in qa_results])
+    sources_section = ""
+    if source_titles:
+        source_lines = "\n".join(f"- {title}" for title in source_titles)
+        sources_section = f"\n出典資料:\n{source_lines}\n"
+    
+    def render(qa_results, contexts):
+        qa_text = "\n\n".join([f"**Q: {q}**\nA: {a}" for q, a in qa_results])
+        contexts_section = "" if contexts is None else f"\nRAG検索結果:\n{format_contexts(contexts)}\n"
+        return build_synthesis_prompt(user_message, plan_text, qa_text, contexts_section, sources_section)
+    
+    synthesis_prompt = render(qa_results, contexts)
+    if SYNTHESIS_INPUT_TOKEN_BUDGET > 0:
+        # 固定部分（指示・計画・出典名）を除いた枠に回答と検索結果を収める
+        tokens_before = estimate_tokens(synthesis_prompt)
+        fixed_tokens = estimate_tokens(render([], None))
+        # 文の数に対して二乗の比較を行うため、イベントループを止めないよう別スレッドで実行
+        qa_results, contexts, counts = await asyncio.to_thread(
+            compress_synthesis_inputs,
+            qa_results, contexts, source_titles, max(0, SYNTHESIS_INPUT_TOKEN_BUDGET - fixed_tokens)
+        )
+        synthesis_prompt = render(qa_results, contexts)
+        tokens_after = estimate_tokens(synthesis_prompt)
+        
+        print(f"Synthesis prompt: ~{tokens_before} -> ~{tokens_after} tokens "
+              f"(duplicates: {counts['duplicates']}, trimmed: {counts['trimmed']}, contexts dropped: {counts['contexts_dropped']})")
+        synthesis_prompt_stats.inc('requests')
+        synthesis_prompt_stats.inc('input_tokens_before', tokens_before)
+        synthesis_prompt_stats.inc('input_tokens_after', tokens_after)
+        synthesis_prompt_stats.inc('input_tokens_saved', tokens_before - tokens_after)
+        synthesis_prompt_stats.inc('sentences_deduplicated', counts['duplicates'])
+        synthesis_prompt_stats.inc('sentences_trimmed', counts['trimmed'])
+        synthesis_prompt_stats.inc('contexts_dropped', counts['contexts_dropped'])
     
     contents = [
         types.Content(
@@ -551,29 +2533,58 @@ def synthesize_comprehensive_answer(user_message, plan_text, qa_results):
         )
     ]
     
-    # RAGツールを使用して包括的回答を生成
-    config = create_generate_config(temperature=0.7, include_tools=True)
+    # RAGツール（または共有検索ステージの検索結果）を使用して包括的回答を生成
+    config = get_generate_config('synthesis' if contexts is None else 'synthesis_inline')
+    
+    fallback_text = f"## 🎯 包括的な回答\n\n{original_qa_text}\n\n*注: 上記の調査結果を基にした包括的な回答です。*"
+    started_at = time.monotonic()
+    deadline = None if timeout is None else started_at + timeout
+    ttfb = None
     
     try:
-        response = client.models.generate_content(
+        async with aclosing(upstream_gateway.generate_content_stream(
+            'synthesis',
             model=GEMINI_MODEL,
             contents=contents,
             config=config,
-        )
+        )) as stream:
+            async for chunk in iterate_with_deadline(stream, deadline):
+                text = get_chunk_text(chunk)
+                if text:
+                    if ttfb is None:
+                        ttfb = time.monotonic() - started_at
+                    yield text
         
-        if response.text:
-            return response.text
-        else:
+        stage_latency.record('synthesis', ttfb, time.monotonic() - started_at)
+        
+        if ttfb is None:
             # RAGツールが失敗した場合のフォールバック
-            return f"## 🎯 包括的な回答\n\n{qa_text}\n\n*注: 上記の調査結果を基にした包括的な回答です。*"
+            yield fallback_text
             
+    except (asyncio.CancelledError, GeneratorExit):
+        cancelled_work.inc('synthesis')
+        raise
+    except TimeoutError:
+        print("Synthesis exceeded the deep mode deadline")
+        deadline_events.inc('synthesis_timeout')
+        cancelled_work.inc('synthesis')
+        if ttfb is None:
+            yield fallback_text
+        else:
+            yield "\n\n*注: 制限時間に達したため、回答をここで打ち切りました。*"
     except Exception as e:
         print(f"Error in synthesize_comprehensive_answer: {e}")
-        # エラー時のフォールバック
-        return f"## 🎯 包括的な回答\n\n{qa_text}\n\n*注: 上記の調査結果を基にした包括的な回答です。*"
+        # エラー時のフォールバック（途中まで送信済みの場合は区切ってから続ける）
+        yield f"\n\n{fallback_text}" if ttfb is not None else fallback_text
 
-def generate_deep_response(user_message, generate_questions=False):
-    """深掘り機能付きのレスポンス生成"""
+async def generate_deep_response(user_message, generate_questions=False, deadline_seconds=None):
+    """深掘り機能付きのレスポンス生成
+    
+    deadline_seconds（省略時はDEEP_MODE_DEADLINE_SECONDS）を過ぎた関連質問は破棄し、
+    期限内に完了した回答だけで包括的な回答を作成する。
+    """
+    budget = DeadlineBudget(DEEP_MODE_DEADLINE_SECONDS if deadline_seconds is None else deadline_seconds)
+    speculation = None
     try:
         # ステップ1: 計画立てと関連質問生成
         yield {
@@ -584,14 +2595,22 @@ def generate_deep_response(user_message, generate_questions=False):
         }
         
         if generate_questions:
-            # AIによる関連質問生成
-            plan_text = generate_plan_and_questions(user_message)
+            if DEEP_MODE_SPECULATIVE_PREFETCH:
+                # 計画立案の待ち時間を使ってデフォルトの関連質問を先行実行
+                speculation = SpeculativePrefetch(generate_default_questions(user_message))
+            
+            # AIによる関連質問生成（時間内に終わらなければデフォルトの関連質問を使用）
+            try:
+                plan_text, questions = await asyncio.wait_for(
+                    generate_plan_and_questions(user_message), budget.planning_timeout()
+                )
+            except TimeoutError:
+                print("Planning exceeded the deep mode deadline, using default questions")
+                deadline_events.inc('planning_timeout')
+                plan_text, questions = generate_default_plan_and_questions(user_message)
         else:
             # デフォルトの関連質問を使用
-            plan_text = generate_default_plan_and_questions(user_message)
-        
-        if not plan_text:
-            plan_text = generate_default_plan_and_questions(user_message)
+            plan_text, questions = generate_default_plan_and_questions(user_message)
         
         yield {
             'chunk': f'\n{plan_text}\n\n## 🔍 詳細調査を開始...\n',
@@ -600,112 +2619,150 @@ def generate_deep_response(user_message, generate_questions=False):
             'step': 'plan_complete'
         }
         
-        # 関連質問を抽出
-        questions = []
-        try:
-            lines = plan_text.split('\n')
-            in_questions_section = False
-            
-            for line in lines:
-                if '関連質問' in line:
-                    in_questions_section = True
-                    continue
-                if in_questions_section and line.strip():
-                    if line.strip().startswith(('1.', '2.', '3.', '4.', '5.')):
-                        question = line.strip()[2:].strip()
-                        if question and question not in questions:
-                            questions.append(question)
-        except Exception as e:
-            print(f"Error extracting questions: {e}")
-            questions = generate_default_questions(user_message)
-        
-        # 質問が少ない場合のフォールバック
-        if len(questions) < 3:
-            questions = generate_default_questions(user_message)
-        
-        # ステップ2: 各関連質問を順次実行
-        qa_results = []
-        all_grounding_metadata = []
-        all_unique_sources = {}  # 重複を避けるため辞書で管理
-        
-        for i, question in enumerate(questions[:5], 1):
+        # ステップ2: 各関連質問を並列実行し、完了した順に回答を送信
+        questions = questions[:5]
+        prefetched = {}
+        if speculation:
+            questions, prefetched = speculation.assign(questions)
+        for i, question in enumerate(questions, 1):
             yield {
                 'chunk': f'\n### 🔍 質問 {i}: {question}\n調査中...\n',
                 'done': False,
                 'grounding_metadata': None,
                 'step': f'query_{i}'
             }
-            
+        
+        # 元の質問と関連質問の検索を一度にまとめて行い、各回答と統合回答で共有する
+        # （失敗した場合は従来どおり生成呼び出しごとに検索ツールを使用）
+        retrieval = None
+        if DEEP_MODE_SHARED_RETRIEVAL:
             try:
-                answer, grounding_metadata = execute_single_rag_query(question)
-                
-                # 回答が空またはエラーの場合のフォールバック
-                if not answer or "エラー" in answer or "取得できません" in answer:
-                    answer = f"この質問についての詳細な情報は現在の資料からは見つかりませんでした。"
-                
-                qa_results.append((question, answer))
+                retrieval = await asyncio.wait_for(
+                    rag_retriever.retrieve_many(
+                        user_message, [question for i, question in enumerate(questions, 1) if i not in prefetched]
+                    ),
+                    budget.subquery_timeout()
+                )
+            except Exception as e:
+                print(f"Shared retrieval failed, falling back to per-call retrieval: {e}")
+                retrieval_stats.inc('failures')
+        
+        query_results = {}  # 質問番号 -> (回答, 変換済みメタデータ)
+        source_records = {}  # 質問番号 -> 日付順の出典（SourceRecord）
+        dropped_queries = []  # 制限時間内に完了せず破棄した質問
+        streamed_answers = {}  # 質問番号 -> 断片として送信済みの回答テキスト
+        
+        async for update in run_rag_queries_concurrently(
+            questions,
+            timeout=budget.subquery_timeout(),
+            hedge_delay=DEEP_MODE_HEDGE_DELAY_SECONDS,
+            prefetched=prefetched,
+            retrieval=retrieval
+        ):
+            if update[0] == 'dropped':
+                _, i, question = update
+                dropped_queries.append({'index': i, 'question': question})
+                deadline_events.inc('subquery_dropped')
                 
-                # 出典情報を処理
-                converted_metadata = None
-                if grounding_metadata:
-                    all_grounding_metadata.append(grounding_metadata)
-                    converted_metadata = convert_grounding_metadata_to_dict(grounding_metadata)
-                    
-                    # 出典情報を統合（重複を避ける）
-                    if converted_metadata and 'grounding_chunks' in converted_metadata:
-                        for chunk in converted_metadata['grounding_chunks']:
-                            if chunk.get('uri'):
-                                all_unique_sources[chunk['uri']] = {
-                                    'title': chunk.get('title', 'タイトルなし'),
-                                    'uri': chunk['uri']
-                                }
+                yield {
+                    'chunk': f'\n**⏱️ 回答 {i}:** 制限時間内に回答が得られなかったため、この質問は包括的な回答から除外しました。\n',
+                    'done': False,
+                    'grounding_metadata': None,
+                    'step': f'timeout_{i}'
+                }
+                continue
+            
+            if update[0] == 'delta':
+                # 回答の断片（本文には含めず、deltaとして別途送信）
+                _, i, delta = update
+                streamed_answers[i] = streamed_answers.get(i, '') + delta
+                yield {
+                    'chunk': '',
+                    'delta': delta,
+                    'done': False,
+                    'grounding_metadata': None,
+                    'step': f'answer_delta_{i}'
+                }
+                continue
+            
+            _, i, question, answer, converted_metadata, error = update
+            if error is not None:
+                print(f"Error in query {i}: {error}")
+                error_answer = f"この質問の処理中にエラーが発生しました: {str(error)}"
+                query_results[i] = (error_answer, None)
                 
-                # 回答を送信
+                yield {
+                    'chunk': f'\n**⚠️ 回答 {i}:** {error_answer}\n',
+                    'done': False,
+                    'grounding_metadata': None,
+                    'step': f'error_{i}'
+                }
+                continue
+            
+            # 回答が空またはエラーの場合のフォールバック
+            if is_failed_answer(answer):
+                answer = f"この質問についての詳細な情報は現在の資料からは見つかりませんでした。"
+            
+            query_results[i] = (answer, converted_metadata)
+            
+            # 回答を送信（断片として送信済みの回答と同じ場合は本文を再送せず、見出しのみ送る。
+            # クライアントは受信中の表示を本文として確定させる）
+            if streamed_answers.get(i) == answer:
+                yield {
+                    'chunk': f'\n**💡 回答 {i}:** ',
+                    'streamed': True,
+                    'done': False,
+                    'grounding_metadata': converted_metadata,
+                    'step': f'answer_{i}'
+                }
+            else:
                 yield {
                     'chunk': f'\n**💡 回答 {i}:** {answer}\n',
                     'done': False,
                     'grounding_metadata': converted_metadata,
                     'step': f'answer_{i}'
                 }
-                
-                # 各質問の出典情報を個別に表示
-                if converted_metadata and 'grounding_chunks' in converted_metadata:
-                    # 出典情報を日付順にソート
-                    sorted_chunks = sort_sources_by_date(converted_metadata['grounding_chunks'])
-                    
-                    sources_text = '\n**📚 この回答の出典:**\n'
-                    for j, chunk in enumerate(sorted_chunks, 1):
-                        title = chunk.get('title', 'タイトルなし')
-                        uri = chunk.get('uri', '')
-                        
-                        # 日付情報を表示に含める
-                        extracted_date = extract_date_from_filename(title)
-                        date_info = f" ({extracted_date.strftime('%Y-%m-%d')})" if extracted_date else ""
-                        
-                        sources_text += f'   {j}. {title}{date_info}\n'
-                        if uri:
-                            sources_text += f'      📎 {uri}\n'
-                    sources_text += '\n'
-                    
-                    yield {
-                        'chunk': sources_text,
-                        'done': False,
-                        'grounding_metadata': None,
-                        'step': f'sources_{i}'
-                    }
-                    
-            except Exception as e:
-                print(f"Error in query {i}: {e}")
-                error_answer = f"この質問の処理中にエラーが発生しました: {str(e)}"
-                qa_results.append((question, error_answer))
+            
+            # 各質問の出典情報を個別に表示（日付順、統合時にも使い回す）
+            source_records[i] = get_source_records(converted_metadata)
+            if converted_metadata and 'grounding_chunks' in converted_metadata:
+                sources_text = '\n**📚 この回答の出典:**\n'
+                for j, record in enumerate(source_records[i], 1):
+                    # 日付情報を表示に含める
+                    sources_text += f'   {j}. {record.title or "タイトルなし"}{record.date_label}\n'
+                    if record.uri:
+                        sources_text += f'      📎 {record.uri}\n'
+                sources_text += '\n'
                 
                 yield {
-                    'chunk': f'\n**⚠️ 回答 {i}:** {error_answer}\n',
+                    'chunk': sources_text,
                     'done': False,
                     'grounding_metadata': None,
-                    'step': f'error_{i}'
+                    'step': f'sources_{i}'
                 }
         
+        # 完了順に関係なく、質問順で回答と出典情報を統合
+        qa_results = []
+        all_grounding_metadata = []
+        all_unique_sources = {}  # 重複を避けるため辞書で管理
+        
+        for i, question in enumerate(questions, 1):
+            if i not in query_results:
+                continue
+            answer, converted_metadata = query_results[i]
+            qa_results.append((question, answer))
+            
+            if converted_metadata:
+                all_grounding_metadata.append(converted_metadata)
+                
+                # 出典情報を統合（重複を避ける）
+                for record in source_records.get(i, ()):
+                    if record.uri:
+                        all_unique_sources[record.uri] = record
+        
+        # 統合した出典は一度だけ日付順にソートし、統合回答・一覧表示・最終メタデータで共有
+        sorted_unique_sources = sort_source_records(all_unique_sources.values())
+        
         # ステップ3: 包括的な回答の統合
         yield {
             'chunk': '\n## 📝 包括的な回答を作成中...\n',
@@ -714,20 +2771,30 @@ def generate_deep_response(user_message, generate_questions=False):
             'step': 'synthesizing'
         }
         
-        comprehensive_answer = synthesize_comprehensive_answer(user_message, plan_text, qa_results)
+        # 包括的な回答は受信した断片ごとに送信
+        answer_prefix = '\n## 🎯 包括的な回答\n\n'
+        async for delta in synthesize_comprehensive_answer(
+            user_message, plan_text, qa_results, timeout=budget.synthesis_timeout(),
+            contexts=retrieval.pooled() if retrieval else None,
+            source_titles=[record.title or 'タイトルなし' for record in sorted_unique_sources]
+        ):
+            yield {
+                'chunk': answer_prefix + delta,
+                'done': False,
+                'grounding_metadata': None,
+                'step': 'synthesis_delta'
+            }
+            answer_prefix = ''
         
         yield {
-            'chunk': f'\n## 🎯 包括的な回答\n\n{comprehensive_answer}\n',
+            'chunk': f'{answer_prefix}\n',
             'done': False,
             'grounding_metadata': None,
             'step': 'synthesis_complete'
         }
         
         # 全ての出典情報を統合して表示
-        if all_unique_sources:
-            # 日付順にソートしてから表示
-            sorted_unique_sources = sort_sources_by_date(list(all_unique_sources.values()))
-            
+        if sorted_unique_sources:
             yield {
                 'chunk': '\n## 📚 全体の出典情報\n\n',
                 'done': False,
@@ -736,16 +2803,10 @@ def generate_deep_response(user_message, generate_questions=False):
             }
             
             sources_summary = ''
-            for i, source_info in enumerate(sorted_unique_sources, 1):
-                title = source_info.get('title', 'タイトルなし')
-                uri = source_info.get('uri', '')
-                
+            for i, record in enumerate(sorted_unique_sources, 1):
                 # 日付情報を表示に含める
-                extracted_date = extract_date_from_filename(title)
-                date_info = f" ({extracted_date.strftime('%Y-%m-%d')})" if extracted_date else ""
-                
-                sources_summary += f'**{i}. {title}{date_info}**\n'
-                sources_summary += f'   📎 {uri}\n\n'
+                sources_summary += f'**{i}. {record.title or "タイトルなし"}{record.date_label}**\n'
+                sources_summary += f'   📎 {record.uri}\n\n'
             
             yield {
                 'chunk': sources_summary,
@@ -757,21 +2818,23 @@ def generate_deep_response(user_message, generate_questions=False):
         # 最終的な出典情報を統合（JSONとして送信）
         final_grounding_metadata = None
         if all_grounding_metadata:
-            # 全ての出典情報を統合し、日付順にソート
-            sorted_unique_sources = sort_sources_by_date(list(all_unique_sources.values()))
+            # 全ての出典情報を統合（日付順）
             final_grounding_metadata = {
-                'grounding_chunks': sorted_unique_sources
+                'grounding_chunks': [record.to_dict(default_title='タイトルなし') for record in sorted_unique_sources]
             }
         
         yield {
             'chunk': '',
             'done': True,
             'grounding_metadata': final_grounding_metadata,
+            'dropped_queries': dropped_queries,
             'step': 'complete'
         }
         
     except Exception as e:
         print(f"Deep response generation error: {e}")
+        if speculation:
+            speculation.cancel()
         yield {
             'chunk': f'\n❌ エラーが発生しました: {str(e)}\n通常モードで回答を試みます...\n',
             'done': False,
@@ -781,7 +2844,7 @@ def generate_deep_response(user_message, generate_questions=False):
         
         # エラー時は通常モードにフォールバック
         try:
-            for chunk_data in generate_response(user_message):
+            async for chunk_data in generate_response(user_message):
                 yield chunk_data
         except Exception as fallback_error:
             print(f"Fallback error: {fallback_error}")
@@ -791,11 +2854,13 @@ def generate_deep_response(user_message, generate_questions=False):
                 'grounding_metadata': None,
                 'step': 'fallback_error'
             }
+    finally:
+        # クライアント切断時も含め、使われなかった先行実行を中止
+        if speculation:
+            speculation.cancel()
 
-def generate_response(user_message):
+async def generate_response(user_message):
     """ユーザーメッセージに対してRAGを使用してレスポンスを生成"""
-    client = create_rag_client()
-    
     # システムプロンプトをユーザーメッセージに統合
     combined_message = f"{RAG_SYSTEM_PROMPT}\n\n質問: {user_message}"
     
@@ -808,31 +2873,45 @@ def generate_response(user_message):
         )
     ]
     
-    # GenerateContentConfigを作成
-    config = create_generate_config(temperature=1, top_p=1, seed=0, include_thinking=True)
+    # 共有のGenerateContentConfigを取得
+    config = get_generate_config('response')
     
     full_response = ""
     grounding_metadata = None
+    started_at = time.monotonic()
+    ttfb = None
     
-    for chunk in client.models.generate_content_stream(
-        model=GEMINI_MODEL,
-        contents=contents,
-        config=config,
-    ):
-        if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
-            continue
-        
-        # テキストを蓄積
-        full_response += chunk.text
-        
-        # グラウンディングメタデータを取得
-        grounding_metadata = extract_grounding_metadata(chunk)
-        
-        yield {
-            'chunk': chunk.text,
-            'done': False,
-            'grounding_metadata': None
-        }
+    try:
+        async with aclosing(upstream_gateway.generate_content_stream(
+            'response',
+            model=GEMINI_MODEL,
+            contents=contents,
+            config=config,
+        )) as stream:
+            async for chunk in stream:
+                if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+                    continue
+                
+                if ttfb is None:
+                    ttfb = time.monotonic() - started_at
+                
+                # テキストを蓄積
+                full_response += chunk.text
+                
+                # グラウンディングメタデータを取得
+                grounding_metadata = extract_grounding_metadata(chunk)
+                
+                yield {
+                    'chunk': chunk.text,
+                    'done': False,
+                    'grounding_metadata': None
+                }
+    except (asyncio.CancelledError, GeneratorExit):
+        # クライアント切断により上流のストリームを中止
+        cancelled_work.inc('response')
+        raise
+    
+    stage_latency.record('response', ttfb, time.monotonic() - started_at)
     
     # 最後に出典情報を送信（辞書形式に変換）
     converted_metadata = convert_grounding_metadata_to_dict(grounding_metadata)
@@ -843,6 +2922,138 @@ def generate_response(user_message):
         'grounding_metadata': converted_metadata
     }
 
+async def generate_cached_response(user_message):
+    """回答キャッシュを利用して通常モードのレスポンスを生成
+    
+    キャッシュヒット時は保存済みのイベント列をそのまま再送し、上流へは問い合わせない。
+    """
+    if not answer_cache.enabled:
+        async for chunk_data in generate_response(user_message):
+            yield chunk_data
+        return
+    
+    cache_key = answer_cache.make_key(user_message, RESPONSE_CONFIG_PARAMS)
+    cached_events = answer_cache.get(cache_key)
+    if cached_events is not None:
+        for chunk_data in cached_events:
+            yield dict(chunk_data)
+        return
+    
+    events = []
+    async for chunk_data in generate_response(user_message):
+        events.append(dict(chunk_data))
+        yield chunk_data
+    
+    # 最後まで生成でき、本文がある場合のみキャッシュ
+    if events and events[-1].get('done') and any(event.get('chunk') for event in events):
+        answer_cache.put(cache_key, events)
+
+class MemoryGovernor:
+    """プロセスのRSSを監視し、しきい値を超えた場合のみフルGCを実行する
+    
+    ストリームごとのフルGCは他の接続も止めるため、RSSがしきい値を超えたか前回から
+    一定以上増えた場合に限り、最短間隔を空けて実行する。自動のGCも含め、
+    世代ごとの回数と停止時間を記録する。
+    """
+    
+    def __init__(self, rss_threshold_bytes, rss_growth_bytes, min_interval_seconds):
+        self.rss_threshold_bytes = rss_threshold_bytes
+        self.rss_growth_bytes = rss_growth_bytes
+        self.min_interval_seconds = min_interval_seconds
+        self._process = psutil.Process()
+        self._collect_lock = threading.Lock()
+        self._last_collect = 0.0
+        self._rss_after_collect = None
+        self._collections = {}  # 理由 -> 回数
+        self._frozen = 0
+        # GCのコールバック内ではロックを使わない（ロック保持中の確保でGCが起きるとデッドロックするため）
+        self._gc_started = None
+        self._gc_counts = [0, 0, 0]
+        self._gc_pause_sum = [0.0, 0.0, 0.0]
+        self._gc_pause_max = [0.0, 0.0, 0.0]
+    
+    def install(self):
+        """GCの停止時間の計測を開始"""
+        gc.callbacks.append(self._on_gc)
+    
+    def _on_gc(self, phase, info):
+        if phase == 'start':
+            self._gc_started = time.perf_counter()
+            return
+        if self._gc_started is None:
+            return
+        pause = time.perf_counter() - self._gc_started
+        self._gc_started = None
+        generation = info['generation']
+        self._gc_counts[generation] += 1
+        self._gc_pause_sum[generation] += pause
+        self._gc_pause_max[generation] = max(self._gc_pause_max[generation], pause)
+    
+    def after_fork(self):
+        """フォークした子プロセス自身のRSSを参照するよう切り替える"""
+        self._process = psutil.Process()
+    
+    def rss(self):
+        return self._process.memory_info().rss
+    
+    def freeze(self):
+        """起動時に作成したオブジェクトを回収したうえでGCの対象から外す"""
+        gc.collect()
+        gc.freeze()
+        self._frozen = gc.get_freeze_count()
+        self._rss_after_collect = self.rss()
+        print(f"Memory governor: froze {self._frozen} objects, RSS {self._rss_after_collect / 2**20:.0f}MB")
+    
+    def maybe_collect(self):
+        """RSSがしきい値を超えていればフルGCを実行（実行した場合True）"""
+        rss = self.rss()
+        if rss >= self.rss_threshold_bytes:
+            reason = 'rss_threshold'
+        elif self.rss_growth_bytes > 0 and self._rss_after_collect is not None and rss - self._rss_after_collect >= self.rss_growth_bytes:
+            reason = 'rss_growth'
+        else:
+            return False
+        
+        # 他のスレッドが実行中、または前回から間もない場合は見送る
+        if not self._collect_lock.acquire(blocking=False):
+            return False
+        try:
+            if time.monotonic() - self._last_collect < self.min_interval_seconds:
+                return False
+            gc.collect()
+            self._last_collect = time.monotonic()
+            self._rss_after_collect = self.rss()
+            self._collections[reason] = self._collections.get(reason, 0) + 1
+        finally:
+            self._collect_lock.release()
+        print(f"Memory governor: full GC ({reason}), RSS {rss / 2**20:.0f}MB -> {self._rss_after_collect / 2**20:.0f}MB")
+        return True
+    
+    def stats(self):
+        """RSS・GCの回数と停止時間を取得"""
+        return {
+            'rss_bytes': self.rss(),
+            'rss_after_last_collect_bytes': self._rss_after_collect,
+            'rss_threshold_bytes': self.rss_threshold_bytes,
+            'frozen_objects': self._frozen,
+            'governor_collections': dict(self._collections),
+            'gc': [
+                {
+                    'generation': generation,
+                    'collections': self._gc_counts[generation],
+                    'pause_seconds_sum': self._gc_pause_sum[generation],
+                    'pause_seconds_max': self._gc_pause_max[generation],
+                }
+                for generation in range(3)
+            ],
+        }
+
+memory_governor = MemoryGovernor(
+    int(MEMORY_GC_RSS_THRESHOLD_MB * 2**20), int(MEMORY_GC_RSS_GROWTH_MB * 2**20), MEMORY_GC_MIN_INTERVAL_SECONDS
+)
+memory_governor.install()
+os.register_at_fork(after_in_child=memory_governor.after_fork)
+
 @app.route('/')
 @auth.login_required
 def index():
@@ -857,6 +3068,783 @@ def health():
         'timestamp': datetime.now().isoformat()
     })
 
+@app.route('/ready')
+def ready():
+    """準備状態の確認エンドポイント（起動時の準備が完了していなければ503）"""
+    # 認証情報やトークンの取得が一時的に失敗していた場合は再試行し、成功すれば準備完了とする
+    if GENAI_CLIENT_WARMUP:
+        startup_profile.retry_failed(WARM_UP_PHASES, warm_up_rag_client_pool, WARM_UP_RETRY_INTERVAL_SECONDS)
+    state = startup_profile.stats()
+    return jsonify(state), 200 if state['ready'] else 503
+
+@app.route('/admin/stats')
+@auth.login_required
+def admin_stats():
+    """内部リソースの利用状況を返す管理用エンドポイント"""
+    return jsonify({
+        'client_pool': rag_client_pool.stats(),
+        'answer_cache': answer_cache.stats(),
+        'subquery_store': subquery_store.stats(),
+        'chat_streams': chat_stream_registry.stats(),
+        'stage_latency': stage_latency.stats(),
+        'cancelled_work': cancelled_work.stats(),
+        'upstream': upstream_gateway.stats(),
+        'retrieval_upstream': retrieval_gateway.stats(),
+        'deadline': deadline_events.stats(),
+        'speculation': speculation_stats.stats(),
+        'retrieval': retrieval_stats.stats(),
+        'synthesis_prompt': synthesis_prompt_stats.stats(),
+        'stream_wire': stream_wire_stats.stats(),
+        'stream_compression': stream_compression_stats.stats(),
+        'memory': memory_governor.stats(),
+        'startup': startup_profile.stats(),
+        'credentials': google_credentials.stats(),
+        'timestamp': datetime.now().isoformat()
+    })
+
+@app.route('/admin/cache/invalidate', methods=['POST'])
+@auth.login_required
+def admin_invalidate_cache():
+    """回答キャッシュを無効化（コーパス再インデックス時など）
+    
+    JSONで`message`を指定した場合はその質問のみ、省略時はサブクエリ結果ストアも含めて全件を削除する。
+    """
+    data = request.get_json(silent=True) or {}
+    message = data.get('message')
+    
+    removed_subqueries = 0
+    if message:
+        removed = answer_cache.invalidate(answer_cache.make_key(message, RESPONSE_CONFIG_PARAMS))
+    else:
+        removed = answer_cache.invalidate()
+        removed_subqueries = subquery_store.invalidate()
+    
+    return jsonify({
+        'removed': removed,
+        'removed_subqueries': removed_subqueries,
+        'answer_cache': answer_cache.stats(),
+        'subquery_store': subquery_store.stats()
+    })
+
+def render_metrics():
+    """Prometheusのテキスト形式で指標を出力"""
+    lines = []
+    for metric in (
+        stage_duration_histogram, stage_ttfb_histogram, upstream_errors_counter, upstream_tokens_counter,
+        stream_frames_counter, stream_bytes_counter,
+        stream_compression_input_counter, stream_compression_output_counter, stream_compression_cpu_counter,
+    ):
+        lines.extend(metric.render())
+    
+    active = chat_stream_registry.active_by_mode()
+    gauges = (
+        ('cmp_chat_active_streams', '生成中のストリーム数', 0),
+        ('cmp_chat_stream_subscribers', '生成中のストリームを受信している接続数', 1),
+    )
+    for name, help_text, index in gauges:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        for mode in ('normal', 'deep'):
+            lines.append(f'{name}{format_metric_labels([("mode", mode)])} {active.get(mode, (0, 0))[index]}')
+    
+    gateways = (('generate', upstream_gateway.stats()), ('retrieval', retrieval_gateway.stats()))
+    lines.append('# HELP cmp_chat_upstream_waiting 上流呼び出しの枠を待っている数')
+    lines.append('# TYPE cmp_chat_upstream_waiting gauge')
+    for name, gateway in gateways:
+        lines.append(f"cmp_chat_upstream_waiting{format_metric_labels([('gateway', name)])} {gateway['waiting']}")
+    lines.append('# HELP cmp_chat_upstream_in_flight 実行中の上流呼び出し数')
+    lines.append('# TYPE cmp_chat_upstream_in_flight gauge')
+    for name, gateway in gateways:
+        lines.append(f"cmp_chat_upstream_in_flight{format_metric_labels([('gateway', name)])} {gateway['in_flight']}")
+    
+    cancelled = cancelled_work.stats()
+    lines.append('# HELP cmp_chat_cancelled_work_total クライアント切断や制限時間超過により中止した処理の件数')
+    lines.append('# TYPE cmp_chat_cancelled_work_total counter')
+    for kind in sorted(set(CANCELLED_WORK_KINDS) | set(cancelled)):
+        lines.append(f'cmp_chat_cancelled_work_total{format_metric_labels([("kind", kind)])} {cancelled.get(kind, 0)}')
+    
+    pool = rag_client_pool.stats()
+    lines.append('# HELP cmp_chat_client_pool_clients 共有genaiクライアントの数（in_use: 貸し出し中、idle: 未使用）')
+    lines.append('# TYPE cmp_chat_client_pool_clients gauge')
+    lines.append(f"cmp_chat_client_pool_clients{format_metric_labels([('state', 'in_use')])} {pool['clients'] - pool['idle_clients']}")
+    lines.append(f"cmp_chat_client_pool_clients{format_metric_labels([('state', 'idle')])} {pool['idle_clients']}")
+    lines.append('# HELP cmp_chat_client_pool_leases 貸し出し中のクライアントの延べ数（1つのクライアントを複数の呼び出しで共有する）')
+    lines.append('# TYPE cmp_chat_client_pool_leases gauge')
+    lines.append(f"cmp_chat_client_pool_leases {pool['in_use']}")
+    
+    memory = memory_governor.stats()
+    lines.append('# HELP cmp_chat_process_rss_bytes プロセスの常駐メモリ（RSS）')
+    lines.append('# TYPE cmp_chat_process_rss_bytes gauge')
+    lines.append(f"cmp_chat_process_rss_bytes {memory['rss_bytes']}")
+    lines.append('# HELP cmp_chat_gc_collections_total 世代ごとのGCの回数')
+    lines.append('# TYPE cmp_chat_gc_collections_total counter')
+    for entry in memory['gc']:
+        lines.append(f'cmp_chat_gc_collections_total{format_metric_labels([("generation", entry["generation"])])} {entry["collections"]}')
+    lines.append('# HELP cmp_chat_gc_pause_seconds_total 世代ごとのGCの停止時間の合計')
+    lines.append('# TYPE cmp_chat_gc_pause_seconds_total counter')
+    for entry in memory['gc']:
+        lines.append(f'cmp_chat_gc_pause_seconds_total{format_metric_labels([("generation", entry["generation"])])} {entry["pause_seconds_sum"]}')
+    lines.append('# HELP cmp_chat_memory_governor_collections_total しきい値超過で実行したフルGCの回数')
+    lines.append('# TYPE cmp_chat_memory_governor_collections_total counter')
+    for reason in ('rss_threshold', 'rss_growth'):
+        lines.append(f'cmp_chat_memory_governor_collections_total{format_metric_labels([("reason", reason)])} {memory["governor_collections"].get(reason, 0)}')
+    
+    startup = startup_profile.stats()
+    lines.append('# HELP cmp_chat_ready 起動時の準備が完了しているか（1: 完了）')
+    lines.append('# TYPE cmp_chat_ready gauge')
+    lines.append(f"cmp_chat_ready {int(startup['ready'])}")
+    lines.append('# HELP cmp_chat_startup_phase_seconds 起動処理の段階ごとの所要時間')
+    lines.append('# TYPE cmp_chat_startup_phase_seconds gauge')
+    for phase in startup['phases']:
+        lines.append(f'cmp_chat_startup_phase_seconds{format_metric_labels([("phase", phase["name"])])} {phase["seconds"]}')
+    return '\n'.join(lines) + '\n'
+
+@app.route('/debug/requests')
+@auth.login_required
+def debug_requests():
+    """直近のリクエストトレースの一覧を返す"""
+    return jsonify({'traces': request_traces.recent()})
+
+@app.route('/debug/requests/<trace_id>')
+@auth.login_required
+def debug_request_trace(trace_id):
+    """リクエストトレース（X-Stream-Idで指定）の処理区間を返す"""
+    trace = request_traces.get(trace_id)
+    if trace is None:
+        return jsonify({'error': 'トレースが見つかりません'}), 404
+    return jsonify(trace.to_dict())
+
+@app.route('/metrics')
+@auth.login_required
+def metrics():
+    """Prometheus形式の指標を返すエンドポイント"""
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class EventLoopThread:
+    """Flaskのワーカースレッドから共有のイベントループで非同期処理を実行する
+    
+    スレッドモードで起動した場合も、上流へのストリーミングはワーカーごとに1つのイベントループで多重化する。
+    """
+    
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+    
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='asyncio-loop', daemon=True).start()
+                self._loop = loop
+            return self._loop
+    
+    def after_fork(self):
+        """フォークした子プロセスには親のループのスレッドがないため、初回の利用時に作り直す"""
+        self._loop = None
+        self._lock = threading.Lock()
+    
+    def run(self, coro):
+        """コルーチンをイベントループ上で実行し、結果を待つ"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+    
+    def iterate(self, async_iterable):
+        """非同期イテレータをイベントループ上で実行し、同期ジェネレータとして結果を返す"""
+        results = queue.Queue()
+        finished = object()
+        
+        async def pump():
+            try:
+                async with aclosing(async_iterable):
+                    async for item in async_iterable:
+                        results.put((item, None))
+            except Exception as e:
+                results.put((finished, e))
+                return
+            results.put((finished, None))
+        
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                item, error = results.get()
+                if item is finished:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            # 途中で終了した場合はイベントループ側の処理も中断する
+            future.cancel()
+
+event_loop_thread = EventLoopThread()
+os.register_at_fork(after_in_child=event_loop_thread.after_fork)
+
+def with_timing_summary(chunk_data):
+    """設定に応じて最後のイベントに処理時間の要約を付ける"""
+    if not TRACE_TIMING_IN_DONE_EVENT or not chunk_data.get('done'):
+        return chunk_data
+    trace = current_trace.get()
+    if trace is None:
+        return chunk_data
+    return dict(chunk_data, timing=trace.summary())
+
+async def chat_events(user_message, use_deep_mode=False, generate_questions=False, deadline_seconds=None):
+    """/chatの応答イベントを順次生成（スレッドモード・非同期モード共通）"""
+    try:
+        if use_deep_mode:
+            # 深掘りモードを使用
+            events = generate_deep_response(user_message, generate_questions, deadline_seconds)
+        else:
+            # 通常モードを使用（キャッシュがあれば再送）
+            events = generate_cached_response(user_message)
+        async with aclosing(events):
+            async for chunk_data in events:
+                yield with_timing_summary(chunk_data)
+        
+    except Exception as e:
+        print(f"Error in chat endpoint: {e}")
+        yield with_timing_summary({
+            'chunk': handle_rag_error(e, "chat endpoint"),
+            'done': True,
+            'grounding_metadata': None
+        })
+
+# 断片をまとめられるイベントのキー（これ以外のキーを持つイベントはそのまま送る）
+MERGEABLE_EVENT_KEYS = frozenset(('chunk', 'delta', 'done', 'grounding_metadata', 'step'))
+
+def is_mergeable_event(chunk_data):
+    """後続の断片とまとめられるイベント（完了・出典を含まない本文の断片）かどうか"""
+    return (
+        not chunk_data.get('done')
+        and chunk_data.get('grounding_metadata') is None
+        and MERGEABLE_EVENT_KEYS.issuperset(chunk_data)
+    )
+
+def merge_stream_events(events):
+    """連続する同じステップの断片を1つにまとめる（バッファ内のイベントは変更しない）"""
+    merged = []
+    for seq, chunk_data in events:
+        if merged and is_mergeable_event(chunk_data):
+            last_seq, last = merged[-1]
+            if (
+                is_mergeable_event(last)
+                and last.get('step') == chunk_data.get('step')
+                and ('delta' in last) == ('delta' in chunk_data)
+            ):
+                combined = dict(last, chunk=last.get('chunk', '') + chunk_data.get('chunk', ''))
+                if 'delta' in last:
+                    combined['delta'] = last['delta'] + chunk_data['delta']
+                merged[-1] = (seq, combined)
+                continue
+        merged.append((seq, chunk_data))
+    return merged
+
+class ChatStream:
+    """1回分の/chat応答を生成し、送信済みイベントをリングバッファに保持する
+    
+    生成はHTTP接続とは独立したタスクで進むため、クライアントが切断しても
+    Last-Event-IDを付けて再接続すれば続きから受信できる。受信者がいない状態が
+    disconnect_grace_secondsを超えて続いた場合は、上流の生成を中止する。
+    """
+    
+    def __init__(self, stream_id, max_events, disconnect_grace_seconds=0, mode='normal', trace=None):
+        self.id = stream_id
+        self.mode = mode
+        self.trace = trace
+        self.events = deque(maxlen=max_events)  # (連番, イベント)
+        self.last_seq = 0
+        self.done = False
+        self.cancelled = False
+        self.finished_at = None
+        self.subscribers = 0
+        self.disconnect_grace_seconds = disconnect_grace_seconds
+        self._changed = asyncio.Condition()
+        self._task = None
+        self._cancel_handle = None
+    
+    def start(self, source):
+        """イベント生成タスクを開始（イベントループ上で呼ぶこと）"""
+        self._task = asyncio.create_task(self._produce(source))
+    
+    async def _produce(self, source):
+        # 生成タスク内（子タスクを含む）の処理をこのストリームのトレースに記録
+        current_trace.set(self.trace)
+        started_at = time.monotonic()
+        ttfb = None
+        try:
+            async with aclosing(source):
+                async for chunk_data in source:
+                    if ttfb is None:
+                        ttfb = time.monotonic() - started_at
+                    async with self._changed:
+                        self.last_seq += 1
+                        self.events.append((self.last_seq, chunk_data))
+                        self._changed.notify_all()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            cancelled_work.inc('stream')
+            raise
+        finally:
+            # ストリーム全体の所要時間（モード別）
+            stage_latency.record(f'stream_{self.mode}', ttfb, time.monotonic() - started_at)
+            if self.trace is not None:
+                self.trace.finish()
+            async with self._changed:
+                self.done = True
+                self.finished_at = time.monotonic()
+                self._changed.notify_all()
+    
+    def _attach(self):
+        self.subscribers += 1
+        if self._cancel_handle is not None:
+            self._cancel_handle.cancel()
+            self._cancel_handle = None
+    
+    def _detach(self):
+        self.subscribers -= 1
+        if self.subscribers > 0 or self.done:
+            return
+        if self.disconnect_grace_seconds <= 0:
+            self.cancel()
+        else:
+            self._cancel_handle = asyncio.get_running_loop().call_later(self.disconnect_grace_seconds, self.cancel)
+    
+    def cancel(self):
+        """受信者がいなければ生成を中止"""
+        self._cancel_handle = None
+        if self.done or self.subscribers > 0 or self._task is None:
+            return
+        self._task.cancel()
+    
+    def can_resume_from(self, seq):
+        """指定した連番の続きがバッファに残っているか"""
+        first_seq = self.events[0][0] if self.events else self.last_seq + 1
+        return first_seq <= seq + 1
+    
+    async def _wait_for_more_locked(self, pending, timeout):
+        """まとめられる断片が続く間、最大timeout秒待って後続のイベントをpendingに追加"""
+        deadline = time.monotonic() + timeout
+        while not self.done and is_mergeable_event(pending[-1][1]):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return
+            pending.extend(self._events_after(pending[-1][0]))
+    
+    def _events_after(self, seq):
+        if not self.events:
+            return []
+        start = max(0, seq + 1 - self.events[0][0])
+        return list(islice(self.events, start, None))
+    
+    async def subscribe(self, after_seq=0, heartbeat_seconds=None, coalesce_seconds=0):
+        """after_seqより後のイベントを (連番, イベント) で返す
+        
+        heartbeat_secondsの間イベントがなければNoneを返す（ハートビート用）。
+        coalesce_secondsを指定すると、断片が短い間隔で届いている間は最大その時間だけ続きを待ち、
+        同じステップの断片を1つのイベントにまとめて返す（連番はまとめた最後のもの）。
+        """
+        seq = after_seq
+        last_fetch = None
+        self._attach()
+        try:
+            while True:
+                async with self._changed:
+                    pending = self._events_after(seq)
+                    if not pending:
+                        if self.done:
+                            return
+                        try:
+                            await asyncio.wait_for(self._changed.wait(), timeout=heartbeat_seconds)
+                        except asyncio.TimeoutError:
+                            pending = None
+                    elif coalesce_seconds > 0:
+                        # 前回の取得から間もない（断片が連続して届いている）場合のみ待つ
+                        now = time.monotonic()
+                        if last_fetch is not None and now - last_fetch < coalesce_seconds:
+                            await self._wait_for_more_locked(pending, coalesce_seconds)
+                        last_fetch = now
+                        pending = merge_stream_events(pending)
+                
+                if pending is None:
+                    yield None
+                    continue
+                for seq, chunk_data in pending:
+                    yield seq, chunk_data
+        finally:
+            # 切断などで受信者がいなくなった場合は猶予後に生成を中止
+            self._detach()
+
+class ChatStreamRegistry:
+    """再開可能なChatStreamを保持する
+    
+    キーを指定して作成したストリームは生成中に限り同じキーで共有でき（シングルフライト）、
+    後から参加した受信者にはバッファの先頭から再送する。
+    ストリームの作成・再開はイベントループ上で行う。統計は他のスレッドからも参照される。
+    """
+    
+    def __init__(self, resume_window_seconds, max_events, disconnect_grace_seconds):
+        self.resume_window_seconds = resume_window_seconds
+        self.max_events = max_events
+        self.disconnect_grace_seconds = disconnect_grace_seconds
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._inflight = {}  # 共有キー -> 生成中のストリーム
+        self._created = 0
+        self._coalesced = 0
+        self._resumed = 0
+        self._resume_misses = 0
+    
+    def _expire_locked(self):
+        now = time.monotonic()
+        expired = [
+            stream_id for stream_id, stream in self._streams.items()
+            if stream.done and now - stream.finished_at > self.resume_window_seconds
+        ]
+        for stream_id in expired:
+            del self._streams[stream_id]
+        finished = [key for key, stream in self._inflight.items() if stream.done]
+        for key in finished:
+            del self._inflight[key]
+    
+    def create(self, source, key=None, mode='normal', message=''):
+        """新しいストリームを作成して生成を開始（ストリームIDをトレースIDとして記録）"""
+        stream_id = uuid.uuid4().hex
+        trace = request_traces.start(stream_id, mode, message)
+        stream = ChatStream(stream_id, self.max_events, self.disconnect_grace_seconds, mode, trace)
+        with self._lock:
+            self._expire_locked()
+            self._streams[stream.id] = stream
+            if key is not None:
+                self._inflight[key] = stream
+            self._created += 1
+        stream.start(source)
+        return stream
+    
+    def join(self, key):
+        """同じキーで生成中のストリームを取得（先頭から再送できなければNone）"""
+        with self._lock:
+            stream = self._inflight.get(key)
+            if stream is None or stream.done or stream.cancelled or not stream.can_resume_from(0):
+                return None
+            self._coalesced += 1
+        return stream
+    
+    def resume(self, last_event_id):
+        """Last-Event-IDから再開先のストリームと連番を取得（再開できなければNone）"""
+        stream_id, _, seq = (last_event_id or '').partition(':')
+        with self._lock:
+            self._expire_locked()
+            stream = self._streams.get(stream_id)
+            if stream is None or stream.cancelled or not seq.isdigit() or not stream.can_resume_from(int(seq)):
+                self._resume_misses += 1
+                return None
+            self._resumed += 1
+        return stream, int(seq)
+    
+    def active_by_mode(self):
+        """モードごとの生成中ストリーム数と受信者数を取得"""
+        with self._lock:
+            active = {}
+            for stream in self._streams.values():
+                if not stream.done:
+                    streams, subscribers = active.get(stream.mode, (0, 0))
+                    active[stream.mode] = (streams + 1, subscribers + stream.subscribers)
+            return active
+    
+    def stats(self):
+        """ストリームの保持状況を取得"""
+        with self._lock:
+            return {
+                'streams': len(self._streams),
+                'active': sum(1 for stream in self._streams.values() if not stream.done),
+                'created': self._created,
+                'coalesced': self._coalesced,
+                'resumed': self._resumed,
+                'resume_misses': self._resume_misses,
+            }
+
+chat_stream_registry = ChatStreamRegistry(
+    STREAM_RESUME_WINDOW_SECONDS, STREAM_BUFFER_MAX_EVENTS, STREAM_DISCONNECT_GRACE_SECONDS
+)
+
+def make_inflight_key(user_message, use_deep_mode, generate_questions, deadline_seconds=None):
+    """生成中のストリームを共有するためのキーを作成"""
+    key_source = json.dumps(
+        [normalize_question(user_message), bool(use_deep_mode), bool(generate_questions), deadline_seconds, GEMINI_MODEL, RAG_CORPUS],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+async def open_chat_stream(user_message, use_deep_mode=False, generate_questions=False, last_event_id=None, deadline_seconds=None):
+    """ストリームを取得する
+    
+    Last-Event-IDがあれば既存ストリームを再開し、同じ質問が生成中であればそれに参加する。
+    どちらでもなければ新しく生成を開始する。(ストリーム, 再開位置の連番, 状態) を返す。
+    状態は 'resumed'（再開）/ 'coalesced'（生成中のストリームに参加）/ 'new' のいずれか。
+    deadline_secondsはリクエストで指定された深掘りモードの制限時間（未検証の値）。
+    """
+    deadline_seconds = resolve_deadline_seconds(deadline_seconds) if use_deep_mode else None
+    
+    if last_event_id:
+        resumed = chat_stream_registry.resume(last_event_id)
+        if resumed is not None:
+            stream, seq = resumed
+            return stream, seq, 'resumed'
+    
+    key = None
+    if COALESCE_INFLIGHT_REQUESTS:
+        key = make_inflight_key(user_message, use_deep_mode, generate_questions, deadline_seconds)
+        stream = chat_stream_registry.join(key)
+        if stream is not None:
+            return stream, 0, 'coalesced'
+    
+    stream = chat_stream_registry.create(
+        chat_events(user_message, use_deep_mode, generate_questions, deadline_seconds),
+        key=key,
+        mode='deep' if use_deep_mode else 'normal',
+        message=user_message
+    )
+    return stream, 0, 'new'
+
+# /chatのストリーム形式ごとのContent-Type
+# json: 従来のSSE / compact: 短縮キーのSSE / msgpack: 長さ付きMessagePackフレーム
+STREAM_CONTENT_TYPES = {
+    'json': 'text/event-stream; charset=utf-8',
+    'compact': 'text/event-stream; charset=utf-8',
+    'msgpack': 'application/x-msgpack',
+}
+
+# 短縮形式のキー（対応のないキーはそのまま）
+COMPACT_EVENT_KEYS = {
+    'chunk': 'c',
+    'done': 'd',
+    'grounding_metadata': 'g',
+    'step': 's',
+    'delta': 't',
+    'dropped_queries': 'q',
+    'timing': 'm',
+    'streamed': 'r',
+}
+
+def resolve_stream_format(requested):
+    """リクエストで指定されたストリーム形式を決定（msgpackが使えなければcompact）"""
+    if requested == 'msgpack':
+        return 'msgpack' if msgpack is not None else 'compact'
+    if requested == 'compact':
+        return 'compact'
+    return 'json'
+
+def stream_response_headers(stream, state, stream_format='json', content_encoding=None):
+    """/chatのストリーミング応答に付けるヘッダー"""
+    headers = dict(SSE_HEADERS, **{
+        'X-Stream-Id': stream.id,
+        'X-Stream-Resumed': 'true' if state == 'resumed' else 'false',
+        'X-Stream-Coalesced': 'true' if state == 'coalesced' else 'false',
+        'X-Stream-Format': stream_format,
+    })
+    if STREAM_COMPRESSION:
+        headers['Vary'] = 'Accept-Encoding'
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
+    return headers
+
+def negotiate_stream_encoding(accept_encoding):
+    """Accept-Encodingから/chatの圧縮方式（br / gzip）を選ぶ（圧縮しない場合はNone）"""
+    if not STREAM_COMPRESSION or not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+class StreamCompressor:
+    """フレームごとに出力をフラッシュする圧縮（クライアントは受信したフレームをすぐに展開できる）"""
+    
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=STREAM_BROTLI_QUALITY, mode=brotli.MODE_TEXT)
+        else:
+            self._compressor = zlib.compressobj(STREAM_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    
+    def compress(self, frame):
+        if self.encoding == 'br':
+            return self._compressor.process(frame) + self._compressor.flush()
+        return self._compressor.compress(frame) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+    
+    def finish(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush(zlib.Z_FINISH)
+
+class StreamCompressionRecorder:
+    """圧縮方式ごとの圧縮率と、1回の応答あたりの圧縮のCPU時間を集計"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._encodings = {}
+    
+    def record(self, encoding, input_bytes, output_bytes, cpu_seconds):
+        stream_compression_input_counter.inc(input_bytes, encoding=encoding)
+        stream_compression_output_counter.inc(output_bytes, encoding=encoding)
+        stream_compression_cpu_counter.inc(cpu_seconds, encoding=encoding)
+        with self._lock:
+            entry = self._encodings.setdefault(encoding, {'answers': 0, 'input': 0, 'output': 0, 'cpu': 0.0})
+            entry['answers'] += 1
+            entry['input'] += input_bytes
+            entry['output'] += output_bytes
+            entry['cpu'] += cpu_seconds
+    
+    def stats(self):
+        with self._lock:
+            return {
+                encoding: {
+                    'answers': entry['answers'],
+                    'ratio': entry['output'] / entry['input'] if entry['input'] else 1.0,
+                    'input_bytes': entry['input'],
+                    'output_bytes': entry['output'],
+                    'cpu_ms_per_answer': entry['cpu'] * 1000 / entry['answers'],
+                }
+                for encoding, entry in self._encodings.items()
+            }
+
+stream_compression_stats = StreamCompressionRecorder()
+
+async def compress_stream(frames, encoding):
+    """フレームを圧縮して送信（フレームの区切りごとにフラッシュする）"""
+    compressor = StreamCompressor(encoding)
+    input_bytes = output_bytes = 0
+    cpu_seconds = 0.0
+    try:
+        async with aclosing(frames):
+            async for frame in frames:
+                started = time.thread_time()
+                data = compressor.compress(frame)
+                cpu_seconds += time.thread_time() - started
+                input_bytes += len(frame)
+                output_bytes += len(data)
+                yield data
+        data = compressor.finish()
+        output_bytes += len(data)
+        yield data
+    finally:
+        stream_compression_stats.record(encoding, input_bytes, output_bytes, cpu_seconds)
+
+def format_sse_event(chunk_data, event_id=None):
+    """イベントをSSE形式に変換"""
+    id_line = f"id: {event_id}\n" if event_id else ""
+    return f"{id_line}data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
+
+def compact_event(chunk_data):
+    """キーを短縮し、値のないフィールド（None・False・空文字列）を除いたイベント"""
+    return {
+        COMPACT_EVENT_KEYS.get(key, key): value
+        for key, value in chunk_data.items()
+        if value is not None and value is not False and value != ''
+    }
+
+def encode_stream_event(chunk_data, event_id, stream_format):
+    """イベントを指定された形式のフレーム（バイト列）に変換"""
+    if stream_format == 'compact':
+        data = json.dumps(compact_event(chunk_data), ensure_ascii=False, separators=(',', ':'))
+        return f"id: {event_id}\ndata: {data}\n\n".encode('utf-8')
+    if stream_format == 'msgpack':
+        body = msgpack.packb(dict(compact_event(chunk_data), i=event_id), use_bin_type=True)
+        return struct.pack('>I', len(body)) + body
+    return format_sse_event(chunk_data, event_id).encode('utf-8')
+
+class StreamWireRecorder:
+    """ストリーム形式ごとに、1回の応答あたりの送信イベント数・フレーム数・バイト数を集計"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._formats = {}
+    
+    def record(self, stream_format, events, frames, sent_bytes):
+        stream_frames_counter.inc(frames, format=stream_format)
+        stream_bytes_counter.inc(sent_bytes, format=stream_format)
+        with self._lock:
+            entry = self._formats.setdefault(stream_format, {'answers': 0, 'events': 0, 'frames': 0, 'bytes': 0})
+            entry['answers'] += 1
+            entry['events'] += events
+            entry['frames'] += frames
+            entry['bytes'] += sent_bytes
+    
+    def stats(self):
+        with self._lock:
+            return {
+                stream_format: {
+                    'answers': entry['answers'],
+                    'frames_per_answer': entry['frames'] / entry['answers'],
+                    'bytes_per_answer': entry['bytes'] / entry['answers'],
+                    'events_per_frame': entry['events'] / entry['frames'] if entry['frames'] else 0.0,
+                }
+                for stream_format, entry in self._formats.items()
+            }
+
+stream_wire_stats = StreamWireRecorder()
+
+async def chat_sse_stream(stream, after_seq=0, stream_format='json'):
+    """ChatStreamのイベントをID付きのフレーム（バイト列）として送信し、待機中はハートビートを挟む
+    
+    json・compactはSSE、msgpackは4バイトの長さ（ビッグエンディアン）に続くMessagePackのフレームで、
+    長さ0のフレームがハートビートになる。短縮形式では細かい断片をまとめて送る。
+    """
+    coalesce_seconds = 0
+    if stream_format == 'msgpack':
+        heartbeat = struct.pack('>I', 0)
+    else:
+        heartbeat = b": keep-alive\n\n"
+        yield f"retry: {STREAM_RETRY_MILLISECONDS}\n\n".encode('utf-8')
+    if stream_format != 'json':
+        coalesce_seconds = STREAM_COALESCE_WINDOW_MS / 1000
+    
+    events = frames = sent_bytes = 0
+    last_seq = after_seq
+    subscription = stream.subscribe(
+        after_seq, heartbeat_seconds=STREAM_HEARTBEAT_SECONDS, coalesce_seconds=coalesce_seconds
+    )
+    try:
+        async with aclosing(subscription):
+            async for item in subscription:
+                if item is None:
+                    yield heartbeat
+                    continue
+                seq, chunk_data = item
+                started = time.monotonic()
+                frame = encode_stream_event(chunk_data, f"{stream.id}:{seq}", stream_format)
+                if stream.trace is not None:
+                    stream.trace.add_total('sse_serialize', time.monotonic() - started)
+                events += seq - last_seq
+                last_seq = seq
+                frames += 1
+                sent_bytes += len(frame)
+                yield frame
+    finally:
+        stream_wire_stats.record(stream_format, events, frames, sent_bytes)
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
+
 @app.route('/chat', methods=['POST'])
 @auth.login_required
 def chat():
@@ -869,30 +3857,38 @@ def chat():
     if not user_message:
         return jsonify({'error': 'メッセージが空です'}), 400
     
+    stream_format = resolve_stream_format(data.get('stream_format'))
+    content_encoding = negotiate_stream_encoding(request.headers.get('Accept-Encoding'))
+    stream, after_seq, state = event_loop_thread.run(open_chat_stream(
+        user_message, use_deep_mode, generate_questions,
+        last_event_id=request.headers.get('Last-Event-ID'),
+        deadline_seconds=data.get('deadline_seconds')
+    ))
+    
     def generate():
         try:
-            if use_deep_mode:
-                # 深掘りモードを使用
-                for chunk_data in generate_deep_response(user_message, generate_questions):
-                    yield f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
-            else:
-                # 通常モードを使用
-                for chunk_data in generate_response(user_message):
-                    yield f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
-            
-        except Exception as e:
-            print(f"Error in chat endpoint: {e}")
-            error_data = {
-                'chunk': handle_rag_error(e, "chat endpoint"),
-                'done': True,
-                'grounding_metadata': None
-            }
-            yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+            # 切断されても生成タスクは継続し、再接続時にバッファから再送する
+            frames = chat_sse_stream(stream, after_seq, stream_format)
+            if content_encoding:
+                frames = compress_stream(frames, content_encoding)
+            yield from event_loop_thread.iterate(frames)
         finally:
-            # 正常・異常終了問わずメモリクリーンアップ
-            gc.collect()
+            # RSSがしきい値を超えている場合のみフルGCを実行
+            memory_governor.maybe_collect()
     
-    return Response(generate(), mimetype='text/plain')
+    return Response(
+        generate(),
+        content_type=STREAM_CONTENT_TYPES[stream_format],
+        headers=stream_response_headers(stream, state, stream_format, content_encoding)
+    )
+
+# 起動時に作成した設定・クライアントなどはプロセス終了まで使うため、GCの走査対象から外す
+# （--preloadで起動した場合はフォーク前に実行され、ワーカーとの共有ページも書き換えにくくなる）
+if GC_FREEZE_AFTER_STARTUP:
+    with startup_profile.phase('gc_freeze'):
+        memory_governor.freeze()
+
+startup_profile.mark_ready()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=True) 
\ No newline at end of file
@@ -0,0 +1,163 @@
+"""非同期サーバー（ASGI）用のエントリーポイント
+
+/chat のストリーミングはワーカーのイベントループ上で直接処理し、同時接続ごとに
+スレッドを占有しない。それ以外のルートは既存のFlaskアプリにWSGI経由で委譲する。
+
+    gunicorn --worker-class uvicorn.workers.UvicornWorker asgi:application
+"""
+import asyncio
+import base64
+import binascii
+import json
+from contextlib import aclosing
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import (
+    STREAM_CONTENT_TYPES, app, chat_sse_stream, compress_stream, memory_governor, negotiate_stream_encoding,
+    open_chat_stream, resolve_stream_format, stream_response_headers, verify_password,
+)
+
+flask_application = WsgiToAsgi(app)
+
+async def read_body(receive):
+    """リクエストボディを最後まで読み込む"""
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+def get_header(scope, name):
+    """リクエストヘッダーの値を取得（なければNone）"""
+    name = name.lower().encode('latin-1')
+    for key, value in scope.get('headers', []):
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+def get_basic_auth(scope):
+    """Authorizationヘッダーからユーザー名とパスワードを取得"""
+    value = get_header(scope, 'authorization')
+    if not value:
+        return None
+    scheme, _, credentials = value.partition(' ')
+    if scheme.lower() != 'basic':
+        return None
+    try:
+        username, _, password = base64.b64decode(credentials).decode('utf-8').partition(':')
+    except (binascii.Error, UnicodeDecodeError):
+        return None
+    return username, password
+
+async def wait_for_disconnect(receive):
+    """クライアントが切断するまで待機"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+async def send_json(send, status, payload, headers=()):
+    """JSONレスポンスを送信"""
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            *headers,
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def chat(scope, receive, send):
+    """チャットエンドポイント（Flask版の/chatと同じイベント形式）"""
+    credentials = get_basic_auth(scope)
+    if not credentials or not verify_password(*credentials):
+        await send_json(
+            send,
+            401,
+            {'error': 'アクセスが拒否されました。正しいユーザー名とパスワードを入力してください。'},
+            headers=[(b'www-authenticate', b'Basic realm="Authentication Required"')],
+        )
+        return
+
+    body = await read_body(receive)
+    if body is None:
+        return
+
+    try:
+        data = json.loads(body or b'{}')
+    except ValueError:
+        await send_json(send, 400, {'error': 'リクエストの形式が正しくありません'})
+        return
+    if not isinstance(data, dict):
+        data = {}
+
+    user_message = data.get('message', '')
+    use_deep_mode = data.get('deep_mode', False)
+    generate_questions = data.get('generate_questions', False)
+
+    if not user_message:
+        await send_json(send, 400, {'error': 'メッセージが空です'})
+        return
+
+    stream_format = resolve_stream_format(data.get('stream_format'))
+    content_encoding = negotiate_stream_encoding(get_header(scope, 'accept-encoding'))
+    stream, after_seq, state = await open_chat_stream(
+        user_message, use_deep_mode, generate_questions,
+        last_event_id=get_header(scope, 'last-event-id'),
+        deadline_seconds=data.get('deadline_seconds')
+    )
+
+    headers = {
+        'Content-Type': STREAM_CONTENT_TYPES[stream_format],
+        **stream_response_headers(stream, state, stream_format, content_encoding),
+    }
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers.items()],
+    })
+    async def send_events():
+        frames = chat_sse_stream(stream, after_seq, stream_format)
+        if content_encoding:
+            frames = compress_stream(frames, content_encoding)
+        async with aclosing(frames):
+            async for frame in frames:
+                await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    # 切断を検知したら送信を打ち切り、受信者のいなくなったストリームは猶予後に生成を中止する
+    sender = asyncio.create_task(send_events())
+    disconnect_watcher = asyncio.create_task(wait_for_disconnect(receive))
+    done, pending = await asyncio.wait({sender, disconnect_watcher}, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    # フルGCは全接続を止めるため、RSSがしきい値を超えた場合のみ実行する
+    memory_governor.maybe_collect()
+    if sender in done:
+        sender.result()
+
+async def lifespan(scope, receive, send):
+    """起動・終了イベントに応答"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    """ASGIアプリケーション本体"""
+    if scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
+    elif scope['type'] == 'http' and scope['path'] == '/chat' and scope['method'] == 'POST':
+        await chat(scope, receive, send)
+    else:
+        await flask_application(scope, receive, send)
@@ -0,0 +1,286 @@
+"""/chatの負荷ベンチマーク（上流は代替実装を使用）
+
+Dockerfileと同じgunicornの起動コマンドでサーバーを起動し、通常モード・深掘りモードの
+/chatを複数の同時接続数で呼び出す。最初のイベントまでの時間・全体の所要時間の
+p50/p95/p99、スループット、サーバーのRSSを表示し、JSONファイルに保存する。
+起動から/readyが200を返すまでの時間と、サーバーが記録した起動処理の内訳も記録する。
+上流の応答時間やエラーの割合はbenchmarks/fake_upstream.pyの環境変数で調整する。
+
+    python benchmarks/bench_chat_load.py
+    python benchmarks/bench_chat_load.py --serving thread --modes deep --concurrency 1,8,32
+    python benchmarks/bench_chat_load.py --baseline benchmarks/results/chat_load-20260101-000000.json
+
+RSSの計測にはpsutilが必要（インストールされていなければ記録しない）。
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import httpx
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+AUTH = ('bench', 'bench')
+
+def load_gunicorn_commands():
+    """Dockerfileの起動コマンド（SERVING_MODEごと）を読み込む"""
+    with open(os.path.join(ROOT_DIR, 'Dockerfile'), encoding='utf-8') as f:
+        dockerfile = f.read()
+    commands = {}
+    for line in re.findall(r'exec (gunicorn [^;\n]+)', dockerfile):
+        serving = 'async' if 'UvicornWorker' in line else 'thread'
+        commands[serving] = line.strip()
+    if not commands:
+        raise RuntimeError('Dockerfileからgunicornの起動コマンドを読み込めませんでした')
+    return commands
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(serving, port):
+    """代替実装の上流を使うgunicornを起動し、(プロセス, 起動時間の記録) を返す
+
+    起動時間の記録は/readyが200を返すまでの秒数と、サーバーが記録した段階ごとの内訳。
+    """
+    command = load_gunicorn_commands()[serving].replace('$PORT', str(port))
+    args = shlex.split(command)
+    args[1:1] = ['-c', os.path.join(BENCHMARK_DIR, 'gunicorn_fake_upstream.py')]
+    env = dict(
+        os.environ,
+        AUTH_USERNAME=AUTH[0],
+        AUTH_PASSWORD=AUTH[1],
+        SERVING_MODE=serving,
+        # 結果の再利用で計測が歪まないようにする
+        SUBQUERY_STORE_PATH='',
+        ANSWER_CACHE_MAX_ENTRIES='0',
+    )
+    server = subprocess.Popen(
+        args, cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    started = time.monotonic()
+    deadline = started + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'gunicornが起動できませんでした: {command}')
+        try:
+            response = httpx.get(f'http://127.0.0.1:{port}/ready', timeout=1)
+            if response.status_code == 200:
+                state = response.json()
+                return server, {
+                    'ready_seconds': round(time.monotonic() - started, 3),
+                    'preloaded': state.get('preloaded'),
+                    'phases_ms': {phase['name']: round(phase['seconds'] * 1000, 1) for phase in state['phases']},
+                }
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.05)
+    stop_server(server)
+    raise RuntimeError('gunicornの起動がタイムアウトしました')
+
+def stop_server(server):
+    try:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait(timeout=10)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(server.pid, signal.SIGKILL)
+
+def server_rss_bytes(server):
+    """gunicornのマスターとワーカーのRSSの合計"""
+    if psutil is None:
+        return None
+    try:
+        process = psutil.Process(server.pid)
+        return sum(p.memory_info().rss for p in [process, *process.children(recursive=True)])
+    except psutil.Error:
+        return None
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+def summarize(values):
+    return {f'p{q}': round(percentile(values, q) * 1000, 1) if values else None for q in (50, 95, 99)}
+
+async def run_chat(client, body):
+    """1回分の/chatを実行し、(最初のイベントまでの秒数, 全体の秒数, 成功したか) を返す"""
+    started = time.monotonic()
+    first_event = None
+    ok = False
+    async with client.stream('POST', '/chat', json=body) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return None, time.monotonic() - started, False
+        async for line in response.aiter_lines():
+            if not line.startswith('data: '):
+                continue
+            if first_event is None:
+                first_event = time.monotonic() - started
+            event = json.loads(line[6:])
+            if event.get('done'):
+                ok = not str(event.get('chunk', '')).startswith('エラーが発生しました')
+    return first_event, time.monotonic() - started, ok
+
+async def run_level(port, mode, concurrency, requests, server):
+    """同時接続数concurrencyでrequests回の/chatを実行して集計"""
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    timeout = httpx.Timeout(600.0)
+    first_events, totals, errors = [], [], 0
+    rss_samples = [server_rss_bytes(server)]
+    counter = iter(range(requests))
+
+    async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}', auth=AUTH, limits=limits, timeout=timeout) as client:
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                # 同じ質問の相乗りやキャッシュを避けるため、毎回異なる質問にする
+                body = {'message': f'ベンチマーク質問 {mode} {concurrency} {i} {time.time_ns()}'}
+                if mode == 'deep':
+                    body.update(deep_mode=True, generate_questions=True)
+                try:
+                    first_event, total, ok = await run_chat(client, body)
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                if first_event is not None:
+                    first_events.append(first_event)
+                totals.append(total)
+                errors += not ok
+
+        async def sample_rss():
+            while True:
+                await asyncio.sleep(0.5)
+                rss_samples.append(server_rss_bytes(server))
+
+        sampler = asyncio.create_task(sample_rss())
+        started = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.monotonic() - started
+        sampler.cancel()
+    rss_samples.append(server_rss_bytes(server))
+    rss_samples = [rss for rss in rss_samples if rss is not None]
+
+    return {
+        'mode': mode,
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': errors,
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_rps': round(requests / elapsed, 3),
+        'first_event_ms': summarize(first_events),
+        'total_ms': summarize(totals),
+        'rss_mb': {
+            'start': round(rss_samples[0] / 2**20, 1),
+            'peak': round(max(rss_samples) / 2**20, 1),
+            'end': round(rss_samples[-1] / 2**20, 1),
+        } if rss_samples else None,
+    }
+
+def print_result(serving, result, baseline=None):
+    def fmt(value):
+        return '-' if value is None else f'{value:.0f}'
+    first_event, total = result['first_event_ms'], result['total_ms']
+    rss = result['rss_mb']['peak'] if result['rss_mb'] else None
+    line = (
+        f"{serving:<7} {result['mode']:<7} {result['concurrency']:>4} {result['errors']:>4} "
+        f"{fmt(first_event['p50']):>7} {fmt(first_event['p95']):>7} {fmt(first_event['p99']):>7} "
+        f"{fmt(total['p50']):>7} {fmt(total['p95']):>7} {fmt(total['p99']):>7} "
+        f"{result['throughput_rps']:>7.2f} {fmt(rss):>6}"
+    )
+    if baseline and baseline['total_ms']['p50'] and total['p50']:
+        line += f"  (p50 {total['p50'] / baseline['total_ms']['p50'] - 1:+.1%})"
+    print(line)
+
+def load_baseline(path):
+    """比較対象の結果を (serving, mode, concurrency) をキーにして読み込む"""
+    if not path:
+        return {}
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    return {(r['serving'], r['mode'], r['concurrency']): r for r in data['results']}
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--serving', default='async,thread', help='SERVING_MODE（カンマ区切り）')
+    parser.add_argument('--modes', default='normal,deep', help='normal / deep（カンマ区切り）')
+    parser.add_argument('--concurrency', default='1,4,16', help='同時接続数（カンマ区切り）')
+    parser.add_argument('--requests', type=int, default=32, help='同時接続数ごとのリクエスト数')
+    parser.add_argument('--warmup', type=int, default=2, help='計測前に実行するリクエスト数')
+    parser.add_argument('--output', help='結果のJSONファイル（省略時はbenchmarks/results/に保存）')
+    parser.add_argument('--baseline', help='比較する過去の結果のJSONファイル')
+    args = parser.parse_args()
+
+    servings = args.serving.split(',')
+    modes = args.modes.split(',')
+    levels = [int(level) for level in args.concurrency.split(',')]
+    baseline = load_baseline(args.baseline)
+    fake_settings = {key: value for key, value in os.environ.items() if key.startswith('FAKE_UPSTREAM_')}
+
+    print(f"{'serving':<7} {'mode':<7} {'conc':>4} {'err':>4} "
+          f"{'first50':>7} {'first95':>7} {'first99':>7} {'total50':>7} {'total95':>7} {'total99':>7} "
+          f"{'req/s':>7} {'rss_mb':>6}")
+    started_at = datetime.now()
+    results = []
+    startup = {}
+    for serving in servings:
+        port = free_port()
+        server, startup[serving] = start_server(serving, port)
+        print(f"{serving}: ready in {startup[serving]['ready_seconds'] * 1000:.0f}ms "
+              f"({', '.join(f'{name} {ms:.0f}ms' for name, ms in startup[serving]['phases_ms'].items())})")
+        try:
+            for mode in modes:
+                if args.warmup:
+                    asyncio.run(run_level(port, mode, 1, args.warmup, server))
+                for concurrency in levels:
+                    result = asyncio.run(run_level(port, mode, concurrency, args.requests, server))
+                    result['serving'] = serving
+                    results.append(result)
+                    print_result(serving, result, baseline.get((serving, mode, concurrency)))
+        finally:
+            stop_server(server)
+
+    output = args.output or os.path.join(
+        BENCHMARK_DIR, 'results', f"chat_load-{started_at.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'started_at': started_at.isoformat(),
+            'revision': git_revision(),
+            'python': sys.version.split()[0],
+            'requests_per_level': args.requests,
+            'fake_upstream': fake_settings,
+            'startup': startup,
+            'results': results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました: {output}")
+
+if __name__ == '__main__':
+    main()
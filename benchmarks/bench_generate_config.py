@@ -0,0 +1,87 @@
+"""GenerateContentConfigの構築コストを計測するマイクロベンチマーク
+
+リクエストごとに設定を作成する場合（従来方式）と、起動時に作成した
+レジストリから取得する場合を比較する。
+
+- original: 変更前のcreate_generate_config（呼び出しごとにThinkingConfigの利用可否を確認）
+- create:   現在のcreate_generate_config（利用可否の確認結果はプロセス内でキャッシュ）
+- registry: 起動時に作成した設定の取得
+
+    python benchmarks/bench_generate_config.py
+"""
+import os
+import sys
+import timeit
+
+# ベンチマーク中は外部リソースを使わない
+os.environ.setdefault('GENAI_CLIENT_WARMUP', 'false')
+os.environ.setdefault('SUBQUERY_STORE_PATH', '')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+from app import types, create_rag_tools, create_safety_settings  # noqa: E402
+
+def original_create_generate_config(temperature=0.8, top_p=0.9, max_tokens=65536, include_tools=True, include_thinking=False, thinking_budget=-1, seed=None, response_schema=None):
+    """変更前のcreate_generate_configの複製（比較用）
+    
+    現在のプロファイルを作成できるよう、後から追加したthinking_budgetとresponse_schemaの引数のみ加えている。
+    """
+    config_params = {
+        'temperature': temperature,
+        'top_p': top_p,
+        'max_output_tokens': max_tokens,
+        'safety_settings': create_safety_settings(),
+    }
+    
+    if seed is not None:
+        config_params['seed'] = seed
+    
+    if include_tools:
+        config_params['tools'] = create_rag_tools()
+    
+    if response_schema is not None:
+        config_params['response_mime_type'] = 'application/json'
+        config_params['response_schema'] = response_schema
+    
+    if include_thinking:
+        # ThinkingConfigが利用可能な場合のみ追加
+        try:
+            thinking_config_available = False
+            if hasattr(types, 'ThinkingConfig'):
+                test_config = types.ThinkingConfig(thinking_budget=-1)
+                thinking_config_available = True
+            else:
+                from google.genai.types import ThinkingConfig
+                test_config = ThinkingConfig(thinking_budget=-1)
+                thinking_config_available = True
+    
+            if thinking_config_available:
+                config_params['thinking_config'] = types.ThinkingConfig(thinking_budget=thinking_budget)
+        except (AttributeError, TypeError, ValueError, ImportError):
+            pass  # ThinkingConfigが利用できない場合は無視
+    
+    # 安全にGenerateContentConfigを作成
+    try:
+        return types.GenerateContentConfig(**config_params)
+    except Exception:
+        # ThinkingConfigを除外して再試行
+        if 'thinking_config' in config_params:
+            del config_params['thinking_config']
+            return types.GenerateContentConfig(**config_params)
+
+def main(number=2000):
+    print(f"{'profile':<16} {'original (µs)':>14} {'create (µs)':>12} {'registry (µs)':>14} {'speedup':>9}")
+    for name, params in app.GENERATE_CONFIG_PROFILES.items():
+        # 複製した従来方式が現在と同じ設定を作ることを確認してから計測する
+        assert original_create_generate_config(**params) == app.get_generate_config(name), name
+        original_seconds = timeit.timeit(lambda: original_create_generate_config(**params), number=number)
+        create_seconds = timeit.timeit(lambda: app.create_generate_config(**params), number=number)
+        registry_seconds = timeit.timeit(lambda: app.get_generate_config(name), number=number)
+        original_us = original_seconds / number * 1e6
+        create_us = create_seconds / number * 1e6
+        registry_us = registry_seconds / number * 1e6
+        print(f"{name:<16} {original_us:>14.1f} {create_us:>12.1f} {registry_us:>14.3f} {original_us / registry_us:>8.0f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""出典メタデータ処理（グラウンディングチャンクの変換と日付順ソート）のマイクロベンチマーク
+
+チャンクごとに属性を調べ、ソートのたびにファイル名から日付を抽出していた従来方式と、
+出典ごとに一度だけ日付を抽出するSourceRecord方式を、チャンク数を変えて比較する。
+深掘りモードと同じく、回答ごとの出典一覧・重複排除・最終的なメタデータまでを計測する。
+
+    python benchmarks/bench_source_metadata.py
+    python benchmarks/bench_source_metadata.py --sizes 10,100,1000,5000 --answers 5
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+from datetime import datetime
+
+# ベンチマーク中は外部リソースを使わない
+os.environ.setdefault('GENAI_CLIENT_WARMUP', 'false')
+os.environ.setdefault('SUBQUERY_STORE_PATH', '')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+from google.genai import types  # noqa: E402
+
+def legacy_extract_date(filename):
+    """従来方式：呼び出しごとに正規表現とstrptimeを実行"""
+    if not filename:
+        return None
+    for pattern in (r'_(\d{8})(?:\.|_|$)', r'(?:^|[^\d])(\d{8})(?:[^\d]|$)'):
+        match = re.search(pattern, filename)
+        if match:
+            try:
+                date_obj = datetime.strptime(match.group(1), '%Y%m%d')
+                if 1900 <= date_obj.year <= 2100:
+                    return date_obj
+            except ValueError:
+                continue
+    return None
+
+def legacy_sort(sources):
+    def get_sort_key(source):
+        title = source.get('title', '')
+        dates = [d for d in (legacy_extract_date(title), legacy_extract_date(source.get('uri', ''))) if d]
+        return (-(max(dates) if dates else datetime(1900, 1, 1)).timestamp(), title.lower())
+    return sorted(sources, key=get_sort_key)
+
+def legacy_convert(grounding_metadata):
+    chunks = []
+    for chunk in grounding_metadata.grounding_chunks:
+        chunk_dict = {}
+        if hasattr(chunk, 'retrieved_context') and chunk.retrieved_context:
+            if hasattr(chunk.retrieved_context, 'title') and chunk.retrieved_context.title:
+                chunk_dict['title'] = chunk.retrieved_context.title
+            if hasattr(chunk.retrieved_context, 'uri') and chunk.retrieved_context.uri:
+                chunk_dict['uri'] = chunk.retrieved_context.uri
+        if hasattr(chunk, 'web') and chunk.web:
+            if not chunk_dict.get('title') and hasattr(chunk.web, 'title'):
+                chunk_dict['title'] = chunk.web.title
+            if not chunk_dict.get('uri') and hasattr(chunk.web, 'uri'):
+                chunk_dict['uri'] = chunk.web.uri
+        if not chunk_dict.get('title') and hasattr(chunk, 'title'):
+            chunk_dict['title'] = chunk.title
+        if not chunk_dict.get('uri') and hasattr(chunk, 'uri'):
+            chunk_dict['uri'] = chunk.uri
+        chunks.append(chunk_dict)
+    return {'grounding_chunks': legacy_sort(chunks)}
+
+def legacy_pipeline(answers):
+    """従来方式：回答ごとに変換・再ソート・日付の再抽出を行い、統合時にも3回ソート"""
+    unique = {}
+    lines = []
+    for grounding_metadata in answers:
+        converted = legacy_convert(grounding_metadata)
+        for chunk in legacy_sort(converted['grounding_chunks']):
+            date = legacy_extract_date(chunk.get('title', 'タイトルなし'))
+            lines.append((chunk.get('title', 'タイトルなし'), date.strftime('%Y-%m-%d') if date else ''))
+            if chunk.get('uri'):
+                unique[chunk['uri']] = {'title': chunk.get('title', 'タイトルなし'), 'uri': chunk['uri']}
+    titles = [source['title'] for source in legacy_sort(list(unique.values()))]
+    for source in legacy_sort(list(unique.values())):
+        legacy_extract_date(source['title'])
+    final = legacy_sort(list(unique.values()))
+    return lines, titles, final
+
+def current_pipeline(answers):
+    """SourceRecord方式：generate_deep_responseと同じ処理"""
+    unique = {}
+    lines = []
+    for grounding_metadata in answers:
+        converted = app.convert_grounding_metadata_to_dict(grounding_metadata)
+        for record in app.get_source_records(converted):
+            lines.append((record.title or 'タイトルなし', record.date_label.strip(' ()')))
+            if record.uri:
+                unique[record.uri] = record
+    sorted_unique = app.sort_source_records(unique.values())
+    titles = [record.title or 'タイトルなし' for record in sorted_unique]
+    for record in sorted_unique:
+        record.date_label
+    final = [record.to_dict(default_title='タイトルなし') for record in sorted_unique]
+    return lines, titles, final
+
+def make_answers(size, answers, seed=0):
+    """日付の位置や有無が異なるファイル名のチャンクを持つメタデータを回答数分作成"""
+    rng = random.Random(seed)
+    names = []
+    for i in range(size):
+        date = f'{rng.randint(1995, 2026)}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}'
+        names.append(rng.choice([
+            f'報告書_{i}_{date}.pdf', f'{date}_議事録_{i}.docx', f'資料{i}-{date}-v2.pdf', f'概要_{i}.pdf',
+        ]))
+    result = []
+    for _ in range(answers):
+        chunks = []
+        for name in rng.sample(names, size):
+            uri = f'gs://corpus/documents/{name}'
+            if rng.random() < 0.2:
+                chunks.append(types.GroundingChunk(web=types.GroundingChunkWeb(title=name, uri=uri)))
+            else:
+                chunks.append(types.GroundingChunk(
+                    retrieved_context=types.GroundingChunkRetrievedContext(title=name, uri=uri)
+                ))
+        result.append(types.GroundingMetadata(grounding_chunks=chunks))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10,100,1000,5000', help='回答あたりのチャンク数（カンマ区切り）')
+    parser.add_argument('--answers', type=int, default=5, help='深掘りモードの回答数')
+    args = parser.parse_args()
+
+    print(f"{'chunks':>7} {'legacy (ms)':>12} {'current (ms)':>13} {'speedup':>8}")
+    for size in (int(size) for size in args.sizes.split(',')):
+        answers = make_answers(size, args.answers)
+        legacy_lines, legacy_titles, legacy_final = legacy_pipeline(answers)
+        lines, titles, final = current_pipeline(answers)
+        assert (lines, titles, final) == (legacy_lines, legacy_titles, legacy_final), '出力が従来方式と一致しません'
+
+        number = max(1, 2000 // size)
+        legacy_ms = timeit.timeit(lambda: legacy_pipeline(answers), number=number) / number * 1000
+        # 日付のキャッシュが効いていない初回と同じ条件で比較する
+        def run_current():
+            app.extract_date_from_filename.cache_clear()
+            current_pipeline(answers)
+        current_ms = timeit.timeit(run_current, number=number) / number * 1000
+        print(f"{size:>7} {legacy_ms:>12.2f} {current_ms:>13.2f} {legacy_ms / current_ms:>7.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""ベンチマーク用のVertex AI（Gemini・RAG検索API）の代替実装
+
+importすると`genai.Client`とRAG検索API（retrieveContexts）の呼び出し先をプロセス内の
+代替実装に置き換え、クォータを使わずにapp.pyを動かせるようにする。
+挙動は以下の環境変数で調整する。
+
+    FAKE_UPSTREAM_FIRST_CHUNK_SECONDS  最初のチャンクを返すまでの時間（秒）
+    FAKE_UPSTREAM_CHUNK_SECONDS        以降のチャンクの間隔（秒）
+    FAKE_UPSTREAM_CHUNKS               ストリーミング応答のチャンク数
+    FAKE_UPSTREAM_CHUNK_CHARS          1チャンクあたりの文字数
+    FAKE_UPSTREAM_SOURCES              グラウンディングメタデータの参照元の数
+    FAKE_UPSTREAM_METADATA             参照元の形式（retrieved / web / mixed / none）
+    FAKE_UPSTREAM_ERROR_RATE           呼び出しが429・503で失敗する割合（0〜1）
+    FAKE_UPSTREAM_RETRIEVAL_SECONDS    RAG検索APIの応答時間（秒）
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+
+import google.auth
+import httpx
+from google import genai
+from google.genai import errors as genai_errors
+from google.genai import types
+from google.oauth2.credentials import Credentials
+
+FIRST_CHUNK_SECONDS = float(os.environ.get('FAKE_UPSTREAM_FIRST_CHUNK_SECONDS', '0.3'))
+CHUNK_SECONDS = float(os.environ.get('FAKE_UPSTREAM_CHUNK_SECONDS', '0.05'))
+CHUNKS = int(os.environ.get('FAKE_UPSTREAM_CHUNKS', '20'))
+CHUNK_CHARS = int(os.environ.get('FAKE_UPSTREAM_CHUNK_CHARS', '40'))
+SOURCES = int(os.environ.get('FAKE_UPSTREAM_SOURCES', '5'))
+METADATA = os.environ.get('FAKE_UPSTREAM_METADATA', 'retrieved')
+ERROR_RATE = float(os.environ.get('FAKE_UPSTREAM_ERROR_RATE', '0'))
+RETRIEVAL_SECONDS = float(os.environ.get('FAKE_UPSTREAM_RETRIEVAL_SECONDS', '0.1'))
+
+# 日付の位置や有無が異なるファイル名（日付順の並べ替えを通すため）
+SOURCE_FILENAMES = [
+    '研究報告書_20240315.pdf',
+    '20231101_会議議事録.docx',
+    '技術資料_2022_20220620_v2.pdf',
+    '製品概要.pdf',
+    'annual_report_20210401.pdf',
+    'メモ_20251230.txt',
+    'spec-19991231-final.pdf',
+]
+
+SAMPLE_TEXT = '提供された資料によると、この技術は複数の段階を経て開発されました。'
+
+PLAN_TEXT = json.dumps({
+    'plan': '1. 基本的な定義を確認する\n2. 具体的な事例を調べる\n3. 最新の動向を整理する',
+    'questions': [
+        '基本的な定義とは何ですか？',
+        '具体的な事例を教えてください',
+        'メリットとデメリットは何ですか？',
+        '最新の動向はどうですか？',
+        '関連する技術や手法はありますか？',
+    ],
+}, ensure_ascii=False)
+
+_lock = threading.Lock()
+calls = {'generate_content': 0, 'generate_content_stream': 0, 'retrieve_contexts': 0, 'errors': 0}
+
+def count(name):
+    with _lock:
+        calls[name] += 1
+
+def maybe_fail():
+    """ERROR_RATEの割合で上流の混雑エラーを送出"""
+    if ERROR_RATE <= 0 or random.random() >= ERROR_RATE:
+        return
+    count('errors')
+    if random.random() < 0.5:
+        raise genai_errors.ClientError(429, {'error': {'code': 429, 'status': 'RESOURCE_EXHAUSTED', 'message': 'fake quota exceeded'}})
+    raise genai_errors.ServerError(503, {'error': {'code': 503, 'status': 'UNAVAILABLE', 'message': 'fake unavailable'}})
+
+def source_filename(index):
+    return SOURCE_FILENAMES[index % len(SOURCE_FILENAMES)]
+
+def make_grounding_metadata():
+    """設定に応じた形式のグラウンディングメタデータを作成"""
+    if METADATA == 'none' or SOURCES <= 0:
+        return None
+    chunks = []
+    for i in range(SOURCES):
+        filename = source_filename(i)
+        uri = f'gs://fake-corpus/documents/{filename}'
+        use_web = METADATA == 'web' or (METADATA == 'mixed' and i % 2 == 1)
+        if use_web:
+            chunks.append(types.GroundingChunk(web=types.GroundingChunkWeb(title=filename, uri=uri)))
+        else:
+            chunks.append(types.GroundingChunk(
+                retrieved_context=types.GroundingChunkRetrievedContext(title=filename, uri=uri, text=SAMPLE_TEXT)
+            ))
+    return types.GroundingMetadata(grounding_chunks=chunks)
+
+def make_response(text, grounding_metadata=None, output_tokens=0):
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(
+            content=types.Content(role='model', parts=[types.Part(text=text)]),
+            grounding_metadata=grounding_metadata,
+        )],
+        usage_metadata=types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=800, candidates_token_count=output_tokens, thoughts_token_count=0,
+        ),
+    )
+
+def chunk_text(index):
+    return (SAMPLE_TEXT * (CHUNK_CHARS // len(SAMPLE_TEXT) + 1))[:CHUNK_CHARS] + f'[{index}]'
+
+class FakeAsyncModels:
+    async def generate_content(self, model, contents, config=None):
+        count('generate_content')
+        await asyncio.sleep(FIRST_CHUNK_SECONDS)
+        maybe_fail()
+        if config is not None and config.response_schema is not None:
+            return make_response(PLAN_TEXT, output_tokens=120)
+        text = ''.join(chunk_text(i) for i in range(CHUNKS))
+        return make_response(text, make_grounding_metadata(), output_tokens=CHUNKS * 10)
+
+    async def generate_content_stream(self, model, contents, config=None):
+        count('generate_content_stream')
+        await asyncio.sleep(FIRST_CHUNK_SECONDS)
+        maybe_fail()
+
+        async def stream():
+            for i in range(CHUNKS):
+                if i > 0:
+                    await asyncio.sleep(CHUNK_SECONDS)
+                last = i == CHUNKS - 1
+                yield make_response(
+                    chunk_text(i), make_grounding_metadata() if last else None, output_tokens=10 if last else 0
+                )
+        return stream()
+
+class FakeAio:
+    def __init__(self):
+        self.models = FakeAsyncModels()
+
+class FakeClient:
+    """genai.Clientの代替（app.pyが使う`client.aio.models`のみ実装）"""
+
+    def __init__(self, *args, **kwargs):
+        self.aio = FakeAio()
+
+def handle_retrieve_contexts(request):
+    """retrieveContextsの応答を作成"""
+    count('retrieve_contexts')
+    query = json.loads(request.content)['query']['text']
+    contexts = [
+        {
+            'sourceUri': f'gs://fake-corpus/documents/{source_filename(i)}',
+            'sourceDisplayName': source_filename(i),
+            'text': f'{SAMPLE_TEXT}（{query[:20]}に関する記述{i}）',
+            'score': 1.0 - i * 0.05,
+        }
+        for i in range(SOURCES)
+    ]
+    return httpx.Response(200, json={'contexts': {'contexts': contexts}})
+
+class FakeRetrievalTransport(httpx.AsyncBaseTransport):
+    async def handle_async_request(self, request):
+        await asyncio.sleep(RETRIEVAL_SECONDS)
+        if ERROR_RATE > 0 and random.random() < ERROR_RATE:
+            count('errors')
+            return httpx.Response(429, json={'error': {'code': 429, 'status': 'RESOURCE_EXHAUSTED'}})
+        return handle_retrieve_contexts(request)
+
+class FakeAsyncClient(httpx.AsyncClient):
+    """RAG検索APIの呼び出しを代替実装に送るhttpx.AsyncClient"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('transport', FakeRetrievalTransport())
+        super().__init__(*args, **kwargs)
+
+def fake_default_credentials(scopes=None, **kwargs):
+    return Credentials(token='fake-token'), 'fake-project'
+
+def install():
+    """genai.Client・httpx.AsyncClient・認証情報の取得を代替実装に置き換える"""
+    genai.Client = FakeClient
+    httpx.AsyncClient = FakeAsyncClient
+    google.auth.default = fake_default_credentials
+
+install()
@@ -0,0 +1,13 @@
+"""ベンチマーク用のgunicorn設定ファイル
+
+マスタープロセスで上流（genai・RAG検索API）を代替実装に置き換えるため、
+フォークしたワーカーが読み込むapp.pyは実際のVertex AIに接続しない。
+
+    gunicorn -c benchmarks/gunicorn_fake_upstream.py --bind :8080 app:app
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_upstream  # noqa: E402,F401
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# appのimport時に上流への接続やストアの作成を行わないよう、import前に設定する
+os.environ.setdefault('GENAI_CLIENT_WARMUP', 'false')
+os.environ.setdefault('SUBQUERY_STORE_PATH', '')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
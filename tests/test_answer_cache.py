@@ -0,0 +1,55 @@
+import app
+
+
+def test_key_ignores_question_formatting():
+    cache = app.AnswerCache(10, 60)
+    params = {'temperature': 0.7}
+    assert cache.make_key('ＳＤＳとは？', params) == cache.make_key('  sdsとは ', params)
+    assert cache.make_key('SDSとは', params) != cache.make_key('SDSとは', {'temperature': 0.2})
+
+
+def test_entry_expires_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, 'monotonic', lambda: now[0])
+    cache = app.AnswerCache(10, 60)
+    cache.put('key', [{'chunk': '回答'}])
+    
+    now[0] += 59
+    assert cache.get('key') == ({'chunk': '回答'},)
+    now[0] += 1
+    assert cache.get('key') is None
+    
+    stats = cache.stats()
+    assert stats['entries'] == 0
+    assert stats['expirations'] == 1
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = app.AnswerCache(2, 60)
+    cache.put('a', [1])
+    cache.put('b', [2])
+    assert cache.get('a') == (1,)
+    cache.put('c', [3])
+    
+    assert cache.get('b') is None
+    assert cache.get('a') == (1,)
+    assert cache.get('c') == (3,)
+    assert cache.stats()['evictions'] == 1
+
+
+def test_disabled_cache_stores_nothing():
+    cache = app.AnswerCache(0, 60)
+    cache.put('key', [1])
+    assert not cache.enabled
+    assert cache.get('key') is None
+
+
+def test_invalidate():
+    cache = app.AnswerCache(10, 60)
+    cache.put('a', [1])
+    cache.put('b', [2])
+    assert cache.invalidate('a') == 1
+    assert cache.invalidate('a') == 0
+    assert cache.invalidate() == 1
+    assert cache.stats()['invalidations'] == 2
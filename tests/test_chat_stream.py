@@ -0,0 +1,80 @@
+import asyncio
+
+import app
+
+
+async def produce(count, release=None):
+    for i in range(1, count + 1):
+        if i == 3 and release is not None:
+            await release.wait()
+        yield {'chunk': f'断片{i}', 'step': 'answer'}
+
+
+async def read(stream, after_seq=0, limit=None):
+    received = []
+    subscription = stream.subscribe(after_seq)
+    async for seq, chunk_data in subscription:
+        received.append((seq, chunk_data['chunk']))
+        if len(received) == limit:
+            break
+    await subscription.aclose()
+    return received
+
+
+def test_resume_continues_after_last_event_id():
+    async def scenario():
+        registry = app.ChatStreamRegistry(60, 100, 5)
+        release = asyncio.Event()
+        stream = registry.create(produce(5, release))
+        
+        # 2件受信した時点で切断し、残りの生成後にLast-Event-IDで再接続する
+        first = await read(stream, limit=2)
+        release.set()
+        resumed_stream, seq = registry.resume(f'{stream.id}:{first[-1][0]}')
+        second = await read(resumed_stream, seq)
+        return stream, resumed_stream, first, second, registry.stats()
+    
+    stream, resumed_stream, first, second, stats = asyncio.run(scenario())
+    assert resumed_stream is stream
+    assert first == [(1, '断片1'), (2, '断片2')]
+    assert second == [(3, '断片3'), (4, '断片4'), (5, '断片5')]
+    assert stats['resumed'] == 1
+
+
+def test_resume_fails_when_events_left_the_buffer():
+    async def scenario():
+        registry = app.ChatStreamRegistry(60, 3, 5)
+        stream = registry.create(produce(5))
+        await read(stream)
+        return stream, registry
+    
+    stream, registry = asyncio.run(scenario())
+    assert registry.resume(f'{stream.id}:1') is None
+    assert registry.resume(f'{stream.id}:2') == (stream, 2)
+    assert registry.stats()['resume_misses'] == 1
+
+
+def test_resume_rejects_unknown_or_malformed_ids():
+    async def scenario():
+        registry = app.ChatStreamRegistry(60, 100, 5)
+        stream = registry.create(produce(1))
+        await read(stream)
+        return stream, registry
+    
+    stream, registry = asyncio.run(scenario())
+    assert registry.resume('unknown:1') is None
+    assert registry.resume(f'{stream.id}:abc') is None
+    assert registry.resume(stream.id) is None
+    assert registry.resume(None) is None
+
+
+def test_stream_without_subscribers_is_cancelled_and_not_resumable():
+    async def scenario():
+        registry = app.ChatStreamRegistry(60, 100, 0)
+        release = asyncio.Event()
+        stream = registry.create(produce(5, release))
+        await read(stream, limit=1)
+        await asyncio.sleep(0.01)
+        return stream.cancelled, stream.done, registry.resume(f'{stream.id}:1')
+    
+    assert asyncio.run(scenario()) == (True, True, None)
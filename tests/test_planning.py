@@ -0,0 +1,61 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import app
+
+
+def run_planning(monkeypatch, text):
+    """計画立案の応答をtextに差し替えてgenerate_plan_and_questionsを実行"""
+    async def generate_content(operation, **kwargs):
+        return SimpleNamespace(text=text)
+    
+    monkeypatch.setattr(app.upstream_gateway, 'generate_content', generate_content)
+    return asyncio.run(app.generate_plan_and_questions('SDS'))
+
+
+def test_schema_limits_question_count():
+    questions = app.PLAN_RESPONSE_SCHEMA.properties['questions']
+    assert questions.min_items == 3
+    assert questions.max_items == 5
+    assert app.PLAN_RESPONSE_SCHEMA.required == ['plan', 'questions']
+    assert app.PLANNING_CONFIG_PARAMS['response_schema'] is app.PLAN_RESPONSE_SCHEMA
+
+
+def test_parse_plan_response():
+    text = json.dumps({'plan': ' 定義から調べる ', 'questions': ['質問A', '質問B', '質問C']})
+    assert app.parse_plan_response(text) == ('定義から調べる', ['質問A', '質問B', '質問C'])
+
+
+def test_parse_plan_response_rejects_invalid_json():
+    assert app.parse_plan_response('1. 質問A\n2. 質問B') is None
+    assert app.parse_plan_response(None) is None
+    assert app.parse_plan_response('["質問A"]') is None
+    assert app.parse_plan_response('{"plan": "計画", "questions": "質問A"}') is None
+
+
+def test_parse_plan_response_drops_blank_and_duplicate_questions():
+    text = json.dumps({'plan': None, 'questions': ['質問A', ' 質問A ', '', '  ', 3, '質問B']})
+    assert app.parse_plan_response(text) == ('', ['質問A', '質問B'])
+
+
+def test_parse_plan_response_keeps_at_most_five_questions():
+    text = json.dumps({'plan': '計画', 'questions': [f'質問{i}' for i in range(1, 8)]})
+    assert app.parse_plan_response(text)[1] == ['質問1', '質問2', '質問3', '質問4', '質問5']
+
+
+def test_invalid_response_falls_back_to_default_plan(monkeypatch):
+    assert run_planning(monkeypatch, 'not json') == app.generate_default_plan_and_questions('SDS')
+
+
+def test_too_few_questions_are_padded_with_defaults(monkeypatch):
+    plan_text, questions = run_planning(monkeypatch, json.dumps({'plan': '計画', 'questions': ['質問A']}))
+    defaults = app.generate_default_questions('SDS')
+    assert questions == ['質問A', defaults[0], defaults[1]]
+    assert '計画' in plan_text
+
+
+def test_too_many_questions_are_truncated(monkeypatch):
+    text = json.dumps({'plan': '計画', 'questions': [f'質問{i}' for i in range(1, 8)]})
+    plan_text, questions = run_planning(monkeypatch, text)
+    assert questions == ['質問1', '質問2', '質問3', '質問4', '質問5']
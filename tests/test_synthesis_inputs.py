@@ -0,0 +1,110 @@
+import asyncio
+
+import app
+
+# 12文字以上の文だけが重複判定の対象になる
+DEFINITION = '安全データシートは化学品の危険有害性を伝える文書です。'
+SIMILAR_DEFINITION = '安全データシートは化学品の危険有害性を伝える文書です！'
+SHORT = '重要です。'
+
+
+def test_repeated_sentence_is_kept_once():
+    qa_results = [('質問A', DEFINITION + '対象は事業者です。'), ('質問B', DEFINITION + '提供は義務です。')]
+    results, contexts, counts = app.compress_synthesis_inputs(qa_results, None, (), 10000)
+    assert results == [('質問A', DEFINITION + '対象は事業者です。'), ('質問B', '提供は義務です。')]
+    assert contexts is None
+    assert counts['duplicates'] == 1
+    assert counts['trimmed'] == 0
+
+
+def test_near_duplicate_above_threshold_is_dropped():
+    qa_results = [('質問A', DEFINITION), ('質問B', SIMILAR_DEFINITION)]
+    results, _, counts = app.compress_synthesis_inputs(qa_results, None, (), 10000)
+    assert results[1] == ('質問B', '')
+    assert counts['duplicates'] == 1
+
+
+def test_threshold_above_one_keeps_duplicates(monkeypatch):
+    monkeypatch.setattr(app, 'SYNTHESIS_DEDUP_THRESHOLD', 1.01)
+    qa_results = [('質問A', DEFINITION), ('質問B', DEFINITION)]
+    results, _, counts = app.compress_synthesis_inputs(qa_results, None, (), 10000)
+    assert results == qa_results
+    assert counts['duplicates'] == 0
+
+
+def test_short_sentences_are_not_deduplicated():
+    qa_results = [('質問A', SHORT), ('質問B', SHORT)]
+    results, _, counts = app.compress_synthesis_inputs(qa_results, None, (), 10000)
+    assert results == qa_results
+    assert counts['duplicates'] == 0
+
+
+def test_duplicate_citing_a_new_source_is_kept():
+    cited = 'JIS Z 7253によると、' + DEFINITION
+    qa_results = [('質問A', DEFINITION), ('質問B', cited)]
+    results, _, counts = app.compress_synthesis_inputs(qa_results, None, ('JIS Z 7253',), 10000)
+    assert results[1] == ('質問B', cited)
+    assert counts['duplicates'] == 0
+
+
+def test_long_sentence_does_not_block_other_answers():
+    long_sentence = 'あ' * 200 + '。'
+    qa_results = [
+        ('質問A', long_sentence + '短い文です。'),
+        ('質問B', '一つ目です。二つ目です。三つ目です。'),
+    ]
+    results, _, counts = app.compress_synthesis_inputs(qa_results, None, (), 30)
+    # 長い文が収まらない回答はそこで打ち切り、後続の短い文を先に詰めることはしない
+    assert results[0] == ('質問A', '\n（以下省略）')
+    assert results[1] == ('質問B', '一つ目です。二つ目です。三つ目です。')
+    assert counts['trimmed'] == 2
+
+
+def test_round_robin_takes_one_sentence_from_each_answer():
+    qa_results = [('質問A', '一つ目です。二つ目です。'), ('質問B', '三つ目です。四つ目です。')]
+    results, _, counts = app.compress_synthesis_inputs(qa_results, None, (), 14)
+    assert results == [('質問A', '一つ目です。\n（以下省略）'), ('質問B', '三つ目です。\n（以下省略）')]
+    assert counts['trimmed'] == 2
+
+
+def test_contexts_fill_the_remaining_budget():
+    contexts = [
+        {'title': '資料1', 'text': DEFINITION},
+        {'title': '資料2', 'text': DEFINITION},
+        {'title': '資料3', 'text': 'い' * 100},
+    ]
+    results, kept, counts = app.compress_synthesis_inputs([('質問A', '短い回答です。')], contexts, (), 60)
+    assert results == [('質問A', '短い回答です。')]
+    assert kept == contexts[:1]
+    assert counts['contexts_dropped'] == 2
+
+
+def test_zero_budget_trims_everything():
+    contexts = [{'title': '資料1', 'text': DEFINITION}]
+    results, kept, counts = app.compress_synthesis_inputs([('質問A', DEFINITION)], contexts, (), 0)
+    assert results == [('質問A', '\n（以下省略）')]
+    assert kept == []
+    assert counts['trimmed'] == 1
+    assert counts['contexts_dropped'] == 1
+
+
+def test_fixed_prompt_larger_than_budget_still_sends_questions(monkeypatch):
+    prompts = []
+    
+    async def generate_content_stream(operation, **kwargs):
+        prompts.append(kwargs['contents'][0].parts[0].text)
+        return
+        yield
+    
+    async def collect():
+        return [text async for text in app.synthesize_comprehensive_answer('SDS', '計画', [('質問A', DEFINITION)])]
+    
+    monkeypatch.setattr(app, 'SYNTHESIS_INPUT_TOKEN_BUDGET', 10)
+    monkeypatch.setattr(app.upstream_gateway, 'generate_content_stream', generate_content_stream)
+    chunks = asyncio.run(collect())
+    
+    assert '質問A' in prompts[0]
+    assert '（以下省略）' in prompts[0]
+    assert DEFINITION not in prompts[0]
+    # 応答がない場合の代替回答は圧縮前の回答から作る
+    assert DEFINITION in chunks[0]